@@ -0,0 +1,72 @@
+"""Back up and restore a JonguBooks story library.
+
+Talks to a running backend through the bulk NDJSON endpoints, streaming
+in both directions so the library is never held in memory here.
+
+Usage:
+    python backend/backup.py [--url http://localhost:8000] export -o stories.ndjson
+    python backend/backup.py [--url http://localhost:8000] import -i stories.ndjson
+"""
+import argparse
+import sys
+
+import httpx
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def export_library(url: str, output: str):
+    with httpx.stream("GET", f"{url}/api/stories/export", timeout=None) as response:
+        response.raise_for_status()
+        out = sys.stdout.buffer if output == "-" else open(output, "wb")
+        try:
+            for chunk in response.iter_bytes(CHUNK_SIZE):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+
+
+def import_library(url: str, input_path: str):
+    def read_chunks():
+        source = sys.stdin.buffer if input_path == "-" else open(input_path, "rb")
+        try:
+            while chunk := source.read(CHUNK_SIZE):
+                yield chunk
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+
+    response = httpx.post(
+        f"{url}/api/stories/import",
+        content=read_chunks(),
+        headers={"Content-Type": "application/x-ndjson"},
+        timeout=None,
+    )
+    response.raise_for_status()
+    result = response.json()
+    print(result["message"], file=sys.stderr)
+    for error in result["data"]["errors"]:
+        print(f"  line {error['line']}: {error['error']}", file=sys.stderr)
+    return 0 if result["success"] else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000", help="backend base URL")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export_cmd = sub.add_parser("export", help="download every story as NDJSON")
+    export_cmd.add_argument("-o", "--output", default="-", help="file to write, '-' for stdout")
+    import_cmd = sub.add_parser("import", help="upload stories from an NDJSON file")
+    import_cmd.add_argument("-i", "--input", default="-", help="file to read, '-' for stdin")
+    args = parser.parse_args()
+
+    url = args.url.rstrip("/")
+    if args.command == "export":
+        export_library(url, args.output)
+        return 0
+    return import_library(url, args.input)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
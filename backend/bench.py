@@ -0,0 +1,957 @@
+"""Benchmarks for the JonguBooks backend.
+
+Upstream OpenAI calls are replaced with sleep-based stubs so the numbers
+measure our own orchestration, not OpenAI's queue.
+
+Usage:
+    python backend/bench.py portraits [--image-latency 0.5] [--chat-latency 0.25]
+    python backend/bench.py textcheck [--seeds 1 2 3]
+    python backend/bench.py startup [--runs 5]
+    python backend/bench.py quota [--users 10000] [--calls 200000]
+    python backend/bench.py bulk [--stories 100000]
+    python backend/bench.py context [--pages 30] [--runs 2000]
+    python backend/bench.py speculation [--pages 12] [--think 0.3]
+    python backend/bench.py routing [--requests 400] [--budget-ms 300]
+    python backend/bench.py admission [--ai-requests 150] [--chat-latency 1.0]
+    python backend/bench.py profiler [--calls 200000]
+    python backend/bench.py reader [--stories 1000] [--pages 12]
+    python backend/bench.py recommend [--stories 100000] [--queries 200]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# main.py mounts "static" relative to the working directory
+APP_DIR = BACKEND_DIR if os.path.isdir(os.path.join(BACKEND_DIR, "static")) else os.path.dirname(BACKEND_DIR)
+os.chdir(APP_DIR)
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+TEXTCHECK_TUNING_SEED = 2024
+
+CAST = [
+    ("Barnaby", "Young bear", "Curious and gentle"),
+    ("Papa Bear", "Wise guide", "Initially skeptical but loving"),
+    ("Mama Bear", "Caring parent", "Warm and patient"),
+    ("Pip", "Tiny sparrow", "Chatty and brave"),
+    ("Old Owl", "Forest elder", "Calm and thoughtful"),
+    ("Rosie", "Rabbit gardener", "Cheerful and hardworking"),
+]
+
+
+def sample_portrait(with_text: bool = False) -> bytes:
+    """Draw a soft, portrait-like PNG, optionally with a caption across it"""
+    from PIL import Image, ImageDraw, ImageFilter, ImageFont
+    image = Image.new("RGB", (1024, 1024), "white")
+    draw = ImageDraw.Draw(image)
+    for i in range(12):
+        x, y, r = 300 + 40 * i, 250 + 50 * (i % 7), 60 + 10 * (i % 5)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=(200 - 8 * i, 140 + 5 * i, 110))
+    image = image.filter(ImageFilter.GaussianBlur(6))
+    if with_text:
+        ImageDraw.Draw(image).text((100, 850), "THE LITTLE GARDEN", font=ImageFont.load_default(size=64), fill="black")
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def stub_openai(main, chat_latency: float, image_latency: float):
+    """Replace the OpenAI and image download clients used by main with sleep stubs"""
+    import httpx
+    portrait = sample_portrait()
+
+    def chat_create(**kwargs):
+        time.sleep(chat_latency)
+        content = json.dumps({name: f"A soft watercolor {kind.lower()}" for name, kind, _ in CAST})
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=1000, completion_tokens=150),
+        )
+
+    def images_generate(**kwargs):
+        time.sleep(image_latency)
+        return SimpleNamespace(data=[SimpleNamespace(url="https://example.com/portrait.png")])
+
+    main.openai_client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=chat_create)),
+        images=SimpleNamespace(generate=images_generate),
+    )
+    main.openai_client.with_options = lambda **options: main.openai_client
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=portrait))
+    main.http_client = httpx.AsyncClient(transport=transport)
+
+
+def bench_portraits(args):
+    import main
+    stub_openai(main, args.chat_latency, args.image_latency)
+    cast = [main.Character(name=name, type=kind, personality=personality) for name, kind, personality in CAST]
+
+    async def sequential():
+        for char in cast:
+            await main.gpt_generate_image(main.ImageGenerationRequest(prompt=f"{char.name}, {char.type}"))
+
+    async def batched():
+        response = await main.gpt_generate_character_portraits(
+            main.CharacterPortraitBatchRequest(characters=[char.model_copy() for char in cast])
+        )
+        async for _ in response.body_iterator:
+            pass
+
+    for label, run in (("sequential generate_image", sequential), ("batched portraits", batched)):
+        started = time.perf_counter()
+        asyncio.run(run())
+        print(f"{label:<28} {len(cast)} characters  {time.perf_counter() - started:6.2f}s")
+
+
+def textcheck_samples(seed: int):
+    """A labeled set of synthetic 1024px portraits: [(name, has_text, png_bytes)].
+
+    Clean portraits carry the textures that fool edge-based checks (stripes,
+    grass, fur, leaves, fences, book spines...); the rest carry captions,
+    titles, signs and speech bubbles at 28-80px.
+    """
+    from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+    def base(rng):
+        image = Image.new("RGB", (1024, 1024), tuple(rng.randint(200, 245) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for i in range(8):
+            x, y, r = rng.randint(0, 1024), rng.randint(0, 1024), rng.randint(120, 300)
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randint(150, 235) for _ in range(3)))
+        image = image.filter(ImageFilter.GaussianBlur(40))
+        draw = ImageDraw.Draw(image)
+        body = tuple(rng.randint(80, 200) for _ in range(3))
+        draw.ellipse((300, 520, 724, 1100), fill=body)
+        draw.ellipse((380, 200, 644, 470), fill=(222, 184, 150))
+        for ex in (450, 574):
+            draw.ellipse((ex - 14, 300, ex + 14, 328), fill=(40, 30, 30))
+        draw.arc((460, 340, 564, 420), 20, 160, fill=(120, 60, 60), width=6)
+        return image, body
+
+    def finish(image, blur=1.2):
+        image = image.filter(ImageFilter.GaussianBlur(blur))
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def shirt_mask():
+        mask = Image.new("L", (1024, 1024), 0)
+        ImageDraw.Draw(mask).ellipse((300, 520, 724, 1100), fill=255)
+        return mask
+
+    def vertical_stripes(image, rng):
+        layer = Image.new("RGB", image.size, (250, 250, 250))
+        draw = ImageDraw.Draw(layer)
+        width = rng.randint(6, 22)
+        color = tuple(rng.randint(20, 120) for _ in range(3))
+        for x in range(0, 1024, width * 2):
+            draw.rectangle((x, 0, x + width - 1, 1024), fill=color)
+        image.paste(layer, (0, 0), shirt_mask())
+
+    def horizontal_stripes(image, rng):
+        layer = Image.new("RGB", image.size, (245, 245, 245))
+        draw = ImageDraw.Draw(layer)
+        width = rng.randint(8, 24)
+        color = tuple(rng.randint(20, 140) for _ in range(3))
+        for y in range(0, 1024, width * 2):
+            draw.rectangle((0, y, 1024, y + width - 1), fill=color)
+        image.paste(layer, (0, 0), shirt_mask())
+
+    def plaid(image, rng):
+        layer = Image.new("RGB", image.size, (230, 210, 190))
+        draw = ImageDraw.Draw(layer)
+        step = rng.randint(24, 48)
+        color = tuple(rng.randint(60, 160) for _ in range(3))
+        for v in range(0, 1024, step):
+            draw.rectangle((v, 0, v + step // 3, 1024), fill=color)
+            draw.rectangle((0, v, 1024, v + step // 3), fill=color)
+        image.paste(layer, (0, 0), shirt_mask())
+
+    def polka_dots(image, rng):
+        layer = image.copy()
+        draw = ImageDraw.Draw(layer)
+        r = rng.randint(6, 14)
+        for y in range(520, 1024, r * 4):
+            for x in range(300 + (y // (r * 4)) % 2 * r * 2, 724, r * 4):
+                draw.ellipse((x - r, y - r, x + r, y + r), fill=(250, 250, 250))
+        image.paste(layer, (0, 0), shirt_mask())
+
+    def grass(image, rng):
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((0, 760, 1024, 1024), fill=(90, 150, 70))
+        for _ in range(rng.randint(100, 300)):
+            x = rng.randint(0, 1024)
+            height = rng.randint(40, 180)
+            lean = rng.randint(-30, 30)
+            shade = rng.randint(30, 110)
+            draw.line((x, 1024, x + lean, 1024 - height), fill=(shade // 2, shade + 60, shade // 3), width=rng.randint(2, 6))
+
+    def fur(image, rng):
+        draw = ImageDraw.Draw(image)
+        for _ in range(rng.randint(800, 1600)):
+            x, y = rng.randint(300, 724), rng.randint(520, 1024)
+            dx, dy = rng.randint(-8, 8), rng.randint(6, 20)
+            shade = rng.randint(60, 140)
+            draw.line((x, y, x + dx, y + dy), fill=(shade, shade - 30, shade - 50), width=2)
+
+    def leaves(image, rng):
+        draw = ImageDraw.Draw(image)
+        for _ in range(rng.randint(300, 600)):
+            x, y = rng.randint(0, 1024), rng.randint(0, 300)
+            w, h = rng.randint(10, 24), rng.randint(6, 14)
+            draw.ellipse((x, y, x + w, y + h), fill=(rng.randint(30, 90), rng.randint(100, 170), rng.randint(30, 80)))
+
+    def bricks(image, rng):
+        draw = ImageDraw.Draw(image)
+        h, w = rng.randint(24, 40), rng.randint(60, 100)
+        for row, y in enumerate(range(0, 200, h)):
+            for x in range(-(row % 2) * w // 2, 1024, w):
+                draw.rectangle((x + 2, y + 2, x + w - 2, y + h - 2), fill=(170, 80 + rng.randint(0, 30), 60))
+
+    def fence(image, rng):
+        draw = ImageDraw.Draw(image)
+        w = rng.randint(14, 30)
+        for x in range(0, 1024, w * 2 + rng.randint(0, 10)):
+            draw.rectangle((x, 680, x + w, 1024), fill=(245, 240, 230), outline=(120, 110, 100), width=2)
+
+    def hair(image, rng):
+        draw = ImageDraw.Draw(image)
+        for _ in range(rng.randint(150, 300)):
+            x = rng.randint(380, 644)
+            points = [(x + rng.randint(-6, 6) * i, 190 + 18 * i) for i in range(6)]
+            draw.line(points, fill=(rng.randint(40, 90), 30, 20), width=3)
+
+    def rain(image, rng):
+        draw = ImageDraw.Draw(image)
+        for _ in range(rng.randint(200, 400)):
+            x, y = rng.randint(0, 1024), rng.randint(0, 1024)
+            draw.line((x, y, x - 6, y + 24), fill=(150, 170, 210), width=2)
+
+    def flowers(image, rng):
+        draw = ImageDraw.Draw(image)
+        for x in range(30, 1024, rng.randint(50, 80)):
+            y = 900 + rng.randint(-30, 30)
+            color = tuple(rng.randint(150, 255) for _ in range(3))
+            for dx, dy in ((-12, 0), (12, 0), (0, -12), (0, 12)):
+                draw.ellipse((x + dx - 10, y + dy - 10, x + dx + 10, y + dy + 10), fill=color)
+            draw.ellipse((x - 7, y - 7, x + 7, y + 7), fill=(240, 200, 40))
+
+    def books(image, rng):
+        draw = ImageDraw.Draw(image)
+        x = 0
+        while x < 1024:
+            w = rng.randint(16, 40)
+            draw.rectangle((x, 40, x + w - 3, 220), fill=tuple(rng.randint(40, 200) for _ in range(3)))
+            x += w
+
+    textures = [vertical_stripes, horizontal_stripes, plaid, polka_dots, grass, fur, leaves, bricks, fence, hair, rain, flowers, books]
+
+    words = ["THE LITTLE GARDEN", "Barnaby's Big Day", "Be Kind", "HELLO!", "The End", "Once upon a time",
+             "Follow your path", "SHARE", "Brave Bear", "Sweet Dreams", "Welcome home", "PLAY"]
+
+    def caption(image, rng):
+        text = rng.choice(words)
+        font = ImageFont.load_default(size=rng.randint(36, 80))
+        ImageDraw.Draw(image).text((rng.randint(40, 200), rng.randint(820, 900)), text, font=font, fill=(20, 20, 20))
+
+    def title_band(image, rng):
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((0, 30, 1024, 150), fill=(40, 50, 90))
+        font = ImageFont.load_default(size=rng.randint(48, 80))
+        draw.text((rng.randint(60, 240), 50), rng.choice(words), font=font, fill=(250, 250, 250))
+
+    def sign(image, rng):
+        draw = ImageDraw.Draw(image)
+        x, y = rng.randint(60, 600), rng.randint(600, 760)
+        draw.rectangle((x, y, x + 360, y + 110), fill=(235, 215, 170), outline=(100, 70, 40), width=6)
+        font = ImageFont.load_default(size=rng.randint(28, 44))
+        draw.text((x + 24, y + 30), rng.choice(words)[:14], font=font, fill=(60, 30, 20))
+
+    def shirt_text(image, rng):
+        font = ImageFont.load_default(size=rng.randint(36, 60))
+        ImageDraw.Draw(image).text((370, rng.randint(640, 760)), rng.choice(words)[:10], font=font, fill=(250, 250, 250))
+
+    def two_lines(image, rng):
+        draw = ImageDraw.Draw(image)
+        font = ImageFont.load_default(size=rng.randint(32, 48))
+        draw.text((80, 800), rng.choice(words), font=font, fill=(30, 30, 30))
+        draw.text((80, 870), rng.choice(words), font=font, fill=(30, 30, 30))
+
+    def speech_bubble(image, rng):
+        draw = ImageDraw.Draw(image)
+        draw.ellipse((600, 60, 1000, 260), fill=(255, 255, 255), outline=(30, 30, 30), width=4)
+        font = ImageFont.load_default(size=rng.randint(30, 44))
+        draw.text((650, 135), rng.choice(words)[:12], font=font, fill=(20, 20, 20))
+
+    def text_over_grass(image, rng):
+        grass(image, rng)
+        caption_top = ImageFont.load_default(size=rng.randint(48, 72))
+        ImageDraw.Draw(image).text((rng.randint(60, 200), 60), rng.choice(words), font=caption_top, fill=(30, 40, 30))
+
+    def text_and_stripes(image, rng):
+        vertical_stripes(image, rng)
+        caption(image, rng)
+
+    writers = [caption, title_band, sign, shirt_text, two_lines, speech_bubble, text_over_grass, text_and_stripes]
+
+    samples = []
+    rng = random.Random(seed)
+    for texture in textures:
+        for variant in range(2):
+            image, _ = base(rng)
+            texture(image, rng)
+            samples.append((f"{texture.__name__} #{variant + 1}", False, finish(image)))
+    for writer in writers:
+        for variant in range(3):
+            image, _ = base(rng)
+            writer(image, rng)
+            samples.append((f"{writer.__name__} #{variant + 1}", True, finish(image)))
+    return samples
+
+
+def bench_textcheck(args):
+    import main
+    for label, seeds in (("tuning set", [TEXTCHECK_TUNING_SEED]), ("held-out", args.seeds)):
+        samples = [(f"{name} (seed {seed})", has_text, image)
+                   for seed in seeds for name, has_text, image in textcheck_samples(seed)]
+        started = time.perf_counter()
+        verdicts = [main.image_contains_text(image) for _, _, image in samples]
+        per_call = (time.perf_counter() - started) / len(samples) * 1000
+        clean = [name for name, has_text, _ in samples if not has_text]
+        texted = [name for name, has_text, _ in samples if has_text]
+        false_pos = [name for (name, has_text, _), found in zip(samples, verdicts) if found and not has_text]
+        false_neg = [name for (name, has_text, _), found in zip(samples, verdicts) if has_text and not found]
+        print(f"{label:<11} false positives {len(false_pos):>2}/{len(clean)} ({len(false_pos) / len(clean):4.0%})  "
+              f"false negatives {len(false_neg):>2}/{len(texted)} ({len(false_neg) / len(texted):4.0%})  {per_call:5.1f} ms/check")
+        for name in false_pos + false_neg:
+            print(f"  missed: {name}")
+
+
+def bench_startup(args):
+    # Fresh interpreters, no API key, so warm-up never reaches the network
+    env = dict(os.environ, OPENAI_API_KEY="", PYTHONPATH=BACKEND_DIR)
+    probe = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    import_times, first_response_times = [], []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, "-c", probe], cwd=APP_DIR, env=env, capture_output=True, text=True, check=True)
+        import_times.append(float(out.stdout.strip().splitlines()[-1]))
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        started = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+            cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            while True:
+                try:
+                    with socket.create_connection(("127.0.0.1", port), timeout=1) as conn:
+                        conn.sendall(b"GET /health HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+                        if conn.recv(64).startswith(b"HTTP/1.1 200"):
+                            break
+                except OSError:
+                    time.sleep(0.01)
+            first_response_times.append(time.perf_counter() - started)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"import main           median {sorted(import_times)[len(import_times) // 2]:.3f}s")
+    print(f"time to first /health median {sorted(first_response_times)[len(first_response_times) // 2]:.3f}s")
+
+
+def bench_quota(args):
+    import main
+    from starlette.requests import Request
+
+    store = tempfile.TemporaryDirectory()
+    tracker = main.UsageTracker(os.path.join(store.name, "usage.json"))
+    main.usage_tracker = tracker
+    for i in range(args.users):
+        keys = ("ip:127.0.0.1", f"ip:127.0.0.1/user:{i}")
+        tracker.record_chat(keys, "gpt-4o", 5, 2)
+        tracker.record_images(keys, "dall-e-3", 0)
+
+    requests = [
+        Request({"type": "http", "headers": [(b"x-user-id", str(i % args.users).encode())], "client": ("127.0.0.1", 0)})
+        for i in range(1000)
+    ]
+
+    async def check_all():
+        for i in range(args.calls):
+            await main.enforce_quota(requests[i % len(requests)])
+
+    started = time.perf_counter()
+    asyncio.run(check_all())
+    per_check = (time.perf_counter() - started) / args.calls * 1e6
+
+    started = time.perf_counter()
+    for i in range(args.calls):
+        tracker.record_chat(("ip:127.0.0.1", f"ip:127.0.0.1/user:{i % args.users}"), "gpt-4o", 5, 2)
+    per_record = (time.perf_counter() - started) / args.calls * 1e6
+
+    started = time.perf_counter()
+    tracker.flush()
+    flush_ms = (time.perf_counter() - started) * 1000
+
+    # Two workers sharing one store must both end up seeing the combined usage
+    path = os.path.join(store.name, "workers.json")
+    workers = [main.UsageTracker(path), main.UsageTracker(path)]
+    for worker in workers:
+        worker.record_chat(("ip:10.0.0.1",), "gpt-4o", 600, 400)
+    for worker in workers + workers:
+        worker.flush()
+    seen = [worker.users["ip:10.0.0.1"]["tokens"] for worker in workers]
+    store.cleanup()
+
+    print(f"quota check (enforce_quota)  {per_check:6.2f} us/request")
+    print(f"usage record                 {per_record:6.2f} us/upstream call")
+    print(f"flush {args.users} users          {flush_ms:8.1f} ms (background thread)")
+    print(f"2 workers x 1000 tokens      each worker sees {seen} tokens after a flush round")
+
+
+def bench_bulk(args):
+    import httpx
+    import main
+
+    main.stories.clear()
+    for i in range(args.stories):
+        story = main.Story(
+            id=f"story-{i}",
+            title=f"Story {i}",
+            coreMessage="It's okay to be different and to follow your own path.",
+            outline="A young bear wants to be a gardener instead of a hunter.",
+            characters=[main.Character(name="Barnaby", type="Young bear", personality="Curious and gentle")],
+            pages=[main.Page(page_number=n, text="Once upon a time, in a cozy den, lived a little bear.") for n in range(1, 13)],
+        )
+        main.stories[story.id] = story
+    # Imports keep the recommendation index current, as in a running server
+    main.recommend_index.directory = tempfile.mkdtemp()
+    main.recommend_index.ensure_built()
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            started = time.perf_counter()
+            response = await client.get("/api/stories/export")
+            body = response.content
+            export_s = time.perf_counter() - started
+
+            main.stories.clear()
+
+            async def chunks():
+                for start in range(0, len(body), 1024 * 1024):
+                    await asyncio.sleep(0)  # a socket read would yield here
+                    yield body[start:start + 1024 * 1024]
+
+            # How late a 5ms timer fires while the import runs: the stall other requests see
+            stalls, due = [], [0.0]
+
+            async def probe():
+                while True:
+                    due[0] = time.perf_counter() + 0.005
+                    await asyncio.sleep(0.005)
+                    stalls.append(time.perf_counter() - due[0])
+
+            prober = asyncio.create_task(probe())
+            await asyncio.sleep(0)
+            started = time.perf_counter()
+            result = (await client.post("/api/stories/import", content=chunks())).json()
+            import_s = time.perf_counter() - started
+            prober.cancel()
+            stalls.append(max(0.0, time.perf_counter() - due[0]))
+        stalls.sort()
+        return len(body), export_s, import_s, result["data"]["imported"], stalls
+
+    size, export_s, import_s, imported, stalls = asyncio.run(run())
+    main.recommend_index.close()
+    print(f"export {args.stories} stories  {export_s:6.2f}s  ({size / 1e6:.0f} MB)")
+    print(f"import {imported} stories  {import_s:6.2f}s")
+    print(f"event loop stall during import  p99 {stalls[int(len(stalls) * 0.99)] * 1000:6.1f} ms  max {stalls[-1] * 1000:6.1f} ms")
+
+
+def bench_context(args):
+    import main
+
+    story = main.Story(
+        title="The Little Bear's Big Dream",
+        coreMessage="It's okay to be different and to follow your own path.",
+        outline="A young bear wants to be a gardener instead of a hunter, and learns to show his family the value of his unique skills.",
+        characters=[
+            main.Character(name=name, type=kind, personality=personality, visual_description=f"A soft watercolor {kind.lower()} with a warm smile")
+            for name, kind, personality in CAST
+        ],
+        pages=[
+            main.Page(
+                page_number=n,
+                text="Barnaby knelt in the warm soil and pressed a tiny seed into the ground, humming softly to himself. " * 2,
+                illustration_prompt="A small bear kneeling in a sunny garden, planting seeds beside a row of tulips",
+            )
+            for n in range(1, args.pages + 1)
+        ],
+    )
+    story.id = "bench-story"
+    main.stories[story.id] = story
+    inline = json.dumps({"page_number": 1, "story_context": main.story_to_context(story)}).encode()
+    by_id = json.dumps({"page_number": 1, "story_id": story.id}).encode()
+
+    def per_call(body):
+        started = time.perf_counter()
+        for _ in range(args.runs):
+            req = main.PageImageGenerationRequest.model_validate_json(body)
+            context = main.resolve_story_context(req.story_id, req.story_version, req.story_context)
+            main.build_ultimate_page_prompt(context, req.page_number)
+        return (time.perf_counter() - started) / args.runs * 1e6
+
+    print(f"{args.pages}-page story      request size   server time")
+    print(f"inline story_context  {len(inline):>8} B  {per_call(inline):8.1f} us/call")
+    print(f"story_id              {len(by_id):>8} B  {per_call(by_id):8.1f} us/call")
+
+
+def bench_speculation(args):
+    import httpx
+    import main
+
+    stub_openai(main, args.chat_latency, args.image_latency)
+    main.QUOTA_DAILY_IMAGES = main.QUOTA_IP_DAILY_IMAGES = 0
+    main.QUOTA_DAILY_TOKENS = main.QUOTA_IP_DAILY_TOKENS = 0
+
+    def make_story(story_id, pages):
+        main.stories[story_id] = main.Story(
+            id=story_id,
+            title="The Little Bear's Big Dream",
+            coreMessage="It's okay to be different and to follow your own path.",
+            characters=[main.Character(name="Barnaby", type="Young bear", personality="Curious and gentle")],
+            pages=[main.Page(page_number=n, text=f"Page {n}: Barnaby tends his garden.") for n in range(1, pages + 1)],
+        )
+
+    async def session(client, flow, speculate):
+        """A parent working through the book one page at a time, reading each result before moving on"""
+        story_id = f"{flow}-{speculate}"
+        make_story(story_id, args.pages if flow == "illustrate" else 1)
+        latencies = []
+        for page_number in range(2, args.pages + 1):
+            await asyncio.sleep(args.think)
+            started = time.perf_counter()
+            if flow == "illustrate":
+                await client.post("/api/gpt/generate_page_image", json={"story_id": story_id, "page_number": page_number})
+            else:
+                previous = main.stories[story_id].pages[-1].text
+                result = (await client.post("/api/gpt/generate_page_text", json={
+                    "story_id": story_id, "page_number": page_number, "previous_text": previous
+                })).json()
+                await client.post(f"/api/stories/{story_id}/pages", json={"page_number": 0, "text": result["data"]["text"]})
+            latencies.append(time.perf_counter() - started)
+            await client.post("/api/gpt/accept_page", json={"story_id": story_id, "page_number": page_number, "speculate": speculate})
+        return sum(latencies) / len(latencies)
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            # Some ordinary traffic first so the speculation budget has spend to take a share of
+            for _ in range(4):
+                await client.post("/api/gpt/generate_image", json={"prompt": "warm-up"})
+            for flow in ("write", "illustrate"):
+                for speculate in (False, True):
+                    main.SPECULATIVE_PREFETCH = speculate
+                    mean = await session(client, flow, speculate)
+                    print(f"{flow:<10} speculation={'on ' if speculate else 'off'}  mean perceived latency {mean:5.2f}s")
+        print(json.dumps(main.speculation_stats.summary()))
+
+    asyncio.run(run())
+
+
+def bench_routing(args):
+    from concurrent.futures import ThreadPoolExecutor
+    import httpx
+    import openai
+    import main
+
+    class UpstreamError(Exception):
+        status_code = 503
+
+    rng = random.Random(7)
+    state = {"sent": 0}
+    degraded = range(args.requests // 5, args.requests * 3 // 5)
+
+    def chat_create(model, timeout=600.0, **kwargs):
+        """Stub upstream: gpt-4o degrades (slow tail, 503s) for the middle of the run"""
+        state["sent"] += 1
+        if model == "gpt-4o" and state["sent"] in degraded:
+            if rng.random() < 0.2:
+                time.sleep(0.05)
+                raise UpstreamError("503 upstream overloaded")
+            latency = rng.lognormvariate(math.log(0.4), 0.6)
+        elif model == "gpt-4o":
+            latency = rng.lognormvariate(math.log(0.08), 0.3)
+        else:
+            latency = rng.lognormvariate(math.log(0.05), 0.3)
+        if latency > timeout:
+            time.sleep(timeout)
+            raise openai.APITimeoutError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+        time.sleep(latency)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Once upon a time..."))],
+            usage=SimpleNamespace(prompt_tokens=400, completion_tokens=80),
+        )
+
+    def with_options(timeout=600.0, max_retries=2):
+        create = lambda **kwargs: chat_create(timeout=timeout, **kwargs)
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    main.openai_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=chat_create)),
+                                         with_options=with_options)
+    messages = [{"role": "user", "content": "Write page 3 of a gentle story about a bear who gardens."}]
+
+    def one_request(_):
+        main.latency_budget_ms.set(args.budget_ms)
+        started = time.perf_counter()
+        try:
+            main.create_chat_completion(model="gpt-4o", messages=messages)
+            ok = True
+        except (UpstreamError, openai.APITimeoutError):
+            ok = False
+        return time.perf_counter() - started, ok
+
+    for routing in (False, True):
+        main.MODEL_ROUTING = routing
+        main.model_health = main.ModelHealth()
+        state["sent"] = 0
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(one_request, range(args.requests)))
+        latencies = sorted(latency for latency, _ in results)
+        failures = sum(1 for _, ok in results if not ok)
+
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        print(f"routing={'on ' if routing else 'off'}  p50 {pct(0.5):6.0f}ms  p95 {pct(0.95):6.0f}ms  "
+              f"p99 {pct(0.99):6.0f}ms  failed {failures}/{args.requests}")
+
+
+def bench_admission(args):
+    from concurrent.futures import ThreadPoolExecutor
+    import httpx
+    import main
+
+    stub_openai(main, args.chat_latency, 0)
+    main.QUOTA_DAILY_TOKENS = main.QUOTA_IP_DAILY_TOKENS = 0
+    main.QUOTA_DAILY_IMAGES = main.QUOTA_IP_DAILY_IMAGES = 0
+    story_id = "bench-story"
+    main.stories[story_id] = main.Story(id=story_id, title="The Little Bear's Big Dream")
+
+    def percentile(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else float("nan")
+
+    async def run(admission):
+        main.ADMISSION_CONTROL = admission
+        main.admission_pools["ai"] = main.AdmissionPool("AI", 16, 32, 2.0)
+        main.admission_pools["crud"] = main.AdmissionPool("CRUD", 64, 256, 2.0)
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=32))
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            done = asyncio.Event()
+            crud_latencies = []
+
+            async def crud_probe():
+                # Latency is measured from when each probe was due, so time the
+                # event loop spent blocked elsewhere is counted too
+                due = time.perf_counter()
+                while not done.is_set() or due < time.perf_counter():
+                    await asyncio.sleep(max(0.0, due - time.perf_counter()))
+                    await client.get(f"/api/stories/{story_id}")
+                    crud_latencies.append(time.perf_counter() - due)
+                    due += 0.01
+
+            async def ai_request(burst_started):
+                response = await client.post("/api/gpt/generate_page_text", json={
+                    "story_title": "The Little Bear's Big Dream", "core_message": "Be yourself", "page_number": 2
+                })
+                return response.status_code, time.perf_counter() - burst_started
+
+            probe = asyncio.create_task(crud_probe())
+            await asyncio.sleep(0.2)
+            burst_started = time.perf_counter()
+            results = await asyncio.gather(*(ai_request(burst_started) for _ in range(args.ai_requests)))
+            done.set()
+            await probe
+
+        served = [latency for status, latency in results if status == 200]
+        shed = [latency for status, latency in results if status == 503]
+        other = len(results) - len(served) - len(shed)
+        print(f"admission={'on ' if admission else 'off'}  CRUD p50 {percentile(crud_latencies, 0.5):5.1f}ms "
+              f"p95 {percentile(crud_latencies, 0.95):5.1f}ms | AI served {len(served)} "
+              f"(p95 {percentile(served, 0.95):6.0f}ms), shed {len(shed)} "
+              f"(p50 {percentile(shed, 0.5):4.0f}ms p95 {percentile(shed, 0.95):4.0f}ms), other {other}")
+
+    for admission in (False, True):
+        asyncio.run(run(admission))
+
+
+def bench_profiler(args):
+    import threading
+    import main
+
+    async def endpoint(scope, receive, send):
+        pass
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/api/stories/bench",
+        "headers": [(b"host", b"localhost"), (b"user-agent", b"Mozilla/5.0"), (b"accept", b"application/json"),
+                    (b"accept-language", b"en-US"), (b"accept-encoding", b"gzip"), (b"connection", b"keep-alive"),
+                    (b"referer", b"http://localhost/"), (b"cookie", b"session=abc"), (b"x-user-id", b"parent-1")],
+    }
+    wrapped = main.ProfilingMiddleware(endpoint)
+    threads_before = threading.active_count()
+
+    async def run(app):
+        started = time.perf_counter()
+        for _ in range(args.calls):
+            await app(scope, None, None)
+        return (time.perf_counter() - started) / args.calls * 1e9
+
+    bare = min(asyncio.run(run(endpoint)) for _ in range(3))
+    with_middleware = min(asyncio.run(run(wrapped)) for _ in range(3))
+    print(f"bare ASGI call              {bare:6.0f} ns")
+    print(f"with ProfilingMiddleware    {with_middleware:6.0f} ns  (+{with_middleware - bare:.0f} ns per request)")
+    print(f"threads started while idle  {threading.active_count() - threads_before}")
+
+
+def bench_reader(args):
+    import httpx
+    import main
+
+    main.stories.clear()
+    for i in range(args.stories):
+        story = main.Story(
+            id=f"story-{i}",
+            title=f"The Little Bear's Big Dream #{i}",
+            coreMessage="It's okay to be different and to follow your own path.",
+            author="Bench Parent",
+            pages=[
+                main.Page(
+                    page_number=n,
+                    text="Barnaby knelt in the warm soil and pressed a tiny seed into the ground, humming softly to himself.",
+                    illustration_url=f"https://images.example.com/story-{i}/page-{n}.png",
+                )
+                for n in range(1, args.pages + 1)
+            ],
+        )
+        main.stories[story.id] = story
+    story_ids = list(main.stories)
+    with open("frontend/index.html", "rb") as f:
+        spa_bytes = len(f.read())
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def timed(headers=None):
+                started = time.perf_counter()
+                for story_id in story_ids:
+                    response = await client.get(f"/s/{story_id}", headers=headers and headers[story_id])
+                return len(story_ids) / (time.perf_counter() - started), response
+
+            main.reader_cache.clear()
+            cold_rps, response = await timed()
+            cached_rps, _ = await timed()
+            etags = {story_id: {"If-None-Match": main.get_reader_page(story_id)[0]} for story_id in story_ids}
+            revalidate_rps, not_modified = await timed(etags)
+            json_bytes = len((await client.get(f"/api/stories/{story_ids[-1]}")).content)
+        return cold_rps, cached_rps, revalidate_rps, len(response.content), not_modified.status_code, json_bytes
+
+    main.reader_cache.clear()
+    started = time.perf_counter()
+    for story_id in story_ids:
+        main.get_reader_page(story_id)
+    render_us = (time.perf_counter() - started) / len(story_ids) * 1e6
+    started = time.perf_counter()
+    for story_id in story_ids:
+        main.get_reader_page(story_id)
+    hit_us = (time.perf_counter() - started) / len(story_ids) * 1e6
+
+    cold_rps, cached_rps, revalidate_rps, page_bytes, status, json_bytes = asyncio.run(run())
+    print(f"{args.pages}-page stories, {args.stories} distinct ids")
+    print(f"render (cache miss)        {render_us:8.1f} us/page")
+    print(f"cache hit                  {hit_us:8.1f} us/page")
+    print(f"GET /s/{{id}} cold          {cold_rps:8.0f} req/s")
+    print(f"GET /s/{{id}} cached        {cached_rps:8.0f} req/s")
+    print(f"GET /s/{{id}} If-None-Match {revalidate_rps:8.0f} req/s  ({status}, empty body)")
+    print(f"bytes to first read: reader page {page_bytes} B vs app shell {spa_bytes} B + story JSON {json_bytes} B")
+
+
+RECOMMEND_THEMES = [
+    ("It's okay to be different", "It's okay to be different and to follow your own path.", "different unique own path special"),
+    ("sharing with friends", "Sharing what we have makes friendships grow.", "share sharing friend together toys"),
+    ("being brave when scared", "Being brave means feeling scared and trying anyway.", "brave scared fear courage dark"),
+    ("saying sorry", "Saying sorry helps fix hurt feelings.", "sorry apologize hurt forgive mistake"),
+    ("trying again after failing", "Mistakes help us learn, so keep trying.", "try again fail practice learn"),
+    ("missing someone you love", "Love stays with us even when someone is far away.", "miss far away love remember"),
+    ("welcoming a new baby", "There is enough love for a new baby and for you.", "baby sibling sister brother new"),
+    ("calming big feelings", "Big feelings pass when we breathe slowly.", "angry breathe calm feelings slow"),
+    ("caring for nature", "Taking care of the earth takes care of us.", "garden trees earth plant care"),
+    ("telling the truth", "Telling the truth builds trust.", "truth honest lie trust tell"),
+]
+RECOMMEND_FILLER = ("once upon a time a small animal lived near the river with a family and walked "
+                    "through the forest every morning to visit the meadow and the old stone bridge").split()
+
+
+def bench_recommend(args):
+    import numpy as np
+    import main
+
+    rng = random.Random(7)
+    animals = ["bear", "fox", "owl", "rabbit", "turtle", "mouse", "otter", "deer"]
+    main.stories.clear()
+    themes = {}
+    for i in range(args.stories):
+        theme, message, words = RECOMMEND_THEMES[i % len(RECOMMEND_THEMES)]
+        words = words.split()
+        pages = []
+        for n in range(1, 13):
+            text = rng.sample(RECOMMEND_FILLER, 12) + rng.sample(words, 2)
+            rng.shuffle(text)
+            pages.append(main.Page(page_number=n, text=" ".join(text)))
+        story = main.Story(
+            id=f"story-{i}",
+            title=f"The {rng.choice(animals).title()} Who Learned {rng.choice(words).title()}",
+            coreMessage=message,
+            outline=f"A {rng.choice(animals)} {rng.choice(RECOMMEND_FILLER)} and {' '.join(rng.sample(words, 2))}.",
+            pages=pages,
+        )
+        main.stories[story.id] = story
+        themes[story.id] = theme
+
+    index = main.recommend_index
+    index.directory = tempfile.mkdtemp()
+    started = time.perf_counter()
+    index.ensure_built()
+    build_s = time.perf_counter() - started
+    file_mb = os.path.getsize(index.path) / 1e6
+
+    story = main.stories["story-0"]
+    started = time.perf_counter()
+    for _ in range(200):
+        index.update(story)
+    update_us = (time.perf_counter() - started) / 200 * 1e6
+
+    def one_query(query):
+        started = time.perf_counter()
+        result = main.recommend([query], [], 10)
+        return (time.perf_counter() - started) * 1000, result[0]
+
+    queries = [RECOMMEND_THEMES[i % len(RECOMMEND_THEMES)][0] for i in range(args.queries)]
+    one_query(queries[0])
+    timings, hits = [], 0
+    for query in queries:
+        ms, result = one_query(query)
+        timings.append(ms)
+        hits += sum(themes[match["id"]] == query for match in result["results"])
+    timings.sort()
+
+    batch = queries[:main.RECOMMEND_MAX_QUERIES]
+    started = time.perf_counter()
+    for _ in range(10):
+        main.recommend(batch, [], 10)
+    batch_ms = (time.perf_counter() - started) / 10 * 1000
+
+    started = time.perf_counter()
+    for i in range(200):
+        index.remove(f"story-{i}")
+    for i in range(200):
+        index.update(main.stories[f"story-{i}"])
+    churn_us = (time.perf_counter() - started) / 400 * 1e6
+    index.close()
+
+    print(f"{args.stories} stories, {main.RECOMMEND_DIMENSIONS} dims, numpy {np.__version__}")
+    print(f"build index               {build_s:8.2f} s   ({file_mb:.0f} MB memory-mapped)")
+    print(f"incremental update        {update_us:8.1f} us/story   remove+re-add {churn_us:.1f} us/story")
+    print(f"single query top-10       p50 {timings[len(timings) // 2]:6.2f} ms   p95 {timings[int(len(timings) * 0.95)]:6.2f} ms")
+    print(f"batch of {len(batch)} queries       {batch_ms:8.2f} ms   ({batch_ms / len(batch):.2f} ms/query)")
+    print(f"precision@10 by theme     {hits / (len(queries) * 10):8.2f}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    portraits = sub.add_parser("portraits", help="6-character cast: sequential vs batched portraits")
+    portraits.add_argument("--image-latency", type=float, default=0.5)
+    portraits.add_argument("--chat-latency", type=float, default=0.25)
+    portraits.set_defaults(func=bench_portraits)
+
+    textcheck = sub.add_parser("textcheck", help="accuracy and cost of the local image text check on labeled portraits")
+    textcheck.add_argument("--seeds", type=int, nargs="+", default=[1, 2, 3], help="held-out sample sets")
+    textcheck.set_defaults(func=bench_textcheck)
+
+    startup = sub.add_parser("startup", help="cold import time and time to first response")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    quota = sub.add_parser("quota", help="per-request overhead of usage accounting")
+    quota.add_argument("--users", type=int, default=10000)
+    quota.add_argument("--calls", type=int, default=200000)
+    quota.set_defaults(func=bench_quota)
+
+    bulk = sub.add_parser("bulk", help="NDJSON export and import throughput")
+    bulk.add_argument("--stories", type=int, default=100000)
+    bulk.set_defaults(func=bench_bulk)
+
+    context = sub.add_parser("context", help="inline story_context vs story_id per generation call")
+    context.add_argument("--pages", type=int, default=30)
+    context.add_argument("--runs", type=int, default=2000)
+    context.set_defaults(func=bench_context)
+
+    speculation = sub.add_parser("speculation", help="perceived next-page latency with and without prefetch")
+    speculation.add_argument("--pages", type=int, default=12)
+    speculation.add_argument("--think", type=float, default=0.3, help="seconds a parent spends on each page")
+    speculation.add_argument("--image-latency", type=float, default=0.5)
+    speculation.add_argument("--chat-latency", type=float, default=0.25)
+    speculation.set_defaults(func=bench_speculation)
+
+    routing = sub.add_parser("routing", help="tail latency with a degrading gpt-4o, router off vs on")
+    routing.add_argument("--requests", type=int, default=400)
+    routing.add_argument("--concurrency", type=int, default=8)
+    routing.add_argument("--budget-ms", type=int, default=300)
+    routing.set_defaults(func=bench_routing)
+
+    admission = sub.add_parser("admission", help="CRUD latency and AI shedding under an AI traffic spike")
+    admission.add_argument("--ai-requests", type=int, default=150)
+    admission.add_argument("--chat-latency", type=float, default=1.0)
+    admission.set_defaults(func=bench_admission)
+
+    profiler = sub.add_parser("profiler", help="per-request cost of the profiler when it isn't running")
+    profiler.add_argument("--calls", type=int, default=200000)
+    profiler.set_defaults(func=bench_profiler)
+
+    reader = sub.add_parser("reader", help="shared /s/ reader pages: cold render vs cached vs 304")
+    reader.add_argument("--stories", type=int, default=1000, help="keep within READER_CACHE_SIZE")
+    reader.add_argument("--pages", type=int, default=12)
+    reader.set_defaults(func=bench_reader)
+
+    recommend = sub.add_parser("recommend", help="similar-story index: build, update and query latency")
+    recommend.add_argument("--stories", type=int, default=100000)
+    recommend.add_argument("--queries", type=int, default=200)
+    recommend.set_defaults(func=bench_recommend)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
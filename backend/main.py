@@ -1,24 +1,348 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile
+from fastapi import FastAPI, HTTPException, File, UploadFile, Request, Response, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, PlainTextResponse, HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict
+from collections import deque, Counter, OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 import uuid
+import zlib
+import functools
+import asyncio
+import hashlib
+import html
+import math
+import secrets
+import string
+import sys
+import threading
+import time
 from datetime import datetime
 import os
 from dotenv import load_dotenv
-import openai
 import json
 import re
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:  # Windows: usage files are written without cross-worker locking
+    fcntl = None
 
 # Load environment variables
 load_dotenv()
 
-# Configure OpenAI client
-openai.api_key = os.getenv("OPENAI_API_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# Heavy SDKs (openai, httpx, Pillow, numpy) are imported on first use so a cold
+# worker can answer its first request without paying for them up front.
+openai_client = None
+http_client = None
+client_lock = threading.Lock()
+
+def get_openai_client():
+    """Return the shared OpenAI client, importing the SDK on first use"""
+    global openai_client
+    if openai_client is None:
+        with client_lock:
+            if openai_client is None:
+                from openai import OpenAI
+                openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    return openai_client
+
+def get_http_client():
+    """Return the shared async HTTP client used to download generated images"""
+    global http_client
+    if http_client is None:
+        import httpx
+        http_client = httpx.AsyncClient(timeout=30.0)
+    return http_client
+
+def import_heavy_modules():
+    """Load the SDKs that requests will need, off the request path"""
+    import PIL.Image
+    import httpx
+    import numpy
+    import openai
+    if OPENAI_API_KEY:
+        get_openai_client()
+
+async def warm_up():
+    """Import heavy modules, build the recommendation index and open the upstream connection pool in the background"""
+    try:
+        await asyncio.to_thread(import_heavy_modules)
+    except Exception as e:
+        print(f"Warm-up import failed: {e}")
+    # Local work first, so a slow or failing upstream can't leave the index unbuilt
+    try:
+        await recommend_index.wait_built()
+    except Exception as e:
+        print(f"Recommendation index build failed: {e}")
+    try:
+        get_http_client()
+        if OPENAI_API_KEY:
+            # Any cheap authenticated call leaves a live TLS connection in the pool
+            await asyncio.to_thread(lambda: get_openai_client().models.list())
+        print("Warm-up complete")
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    seed_dummy_story()
+    usage_tracker.load()
+    # Blocking OpenAI calls run in this pool; size it for the AI concurrency limit
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=UPSTREAM_THREADS, thread_name_prefix="upstream")
+    )
+    warm_up_task = asyncio.create_task(warm_up())
+    flush_task = asyncio.create_task(flush_usage_periodically())
+    yield
+    warm_up_task.cancel()
+    flush_task.cancel()
+    usage_tracker.flush()
+    recommend_index.close()
+    if http_client is not None:
+        await http_client.aclose()
+
+app = FastAPI(title="JonguBooks API", version="1.0.0", lifespan=lifespan)
+
+# Admission control: AI and CRUD routes get separate concurrency pools with
+# bounded wait queues, so a burst of slow generations can't starve CRUD.
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() == "true"
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "16"))
+AI_MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", "32"))
+AI_QUEUE_DEADLINE_SECONDS = float(os.getenv("AI_QUEUE_DEADLINE_SECONDS", "10"))
+CRUD_MAX_CONCURRENCY = int(os.getenv("CRUD_MAX_CONCURRENCY", "64"))
+CRUD_MAX_QUEUE = int(os.getenv("CRUD_MAX_QUEUE", "256"))
+CRUD_QUEUE_DEADLINE_SECONDS = float(os.getenv("CRUD_QUEUE_DEADLINE_SECONDS", "2"))
+UPSTREAM_THREADS = int(os.getenv("UPSTREAM_THREADS", str(AI_MAX_CONCURRENCY * 2)))
+
+class AdmissionPool:
+    """A concurrency limit with a bounded, deadline-limited wait queue"""
+
+    def __init__(self, name: str, limit: int, max_queue: int, deadline_seconds: float):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.deadline_seconds = deadline_seconds
+        self.semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_deadline = 0
+        self.queue_ms = deque(maxlen=1000)
+        self.service_seconds = deque(maxlen=100)
+
+    async def acquire(self) -> Optional[str]:
+        """Wait for a slot; return a rejection reason instead if there isn't one in time"""
+        started = time.perf_counter()
+        if self.semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self.rejected_queue_full += 1
+                return f"Too many {self.name} requests queued"
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.deadline_seconds)
+            except asyncio.TimeoutError:
+                self.rejected_deadline += 1
+                return f"Timed out waiting for a {self.name} slot"
+            finally:
+                self.waiting -= 1
+        else:
+            await self.semaphore.acquire()
+        self.active += 1
+        self.admitted += 1
+        self.queue_ms.append((time.perf_counter() - started) * 1000)
+        return None
+
+    def release(self, service_seconds: float):
+        self.active -= 1
+        self.service_seconds.append(service_seconds)
+        self.semaphore.release()
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely free, from recent service times"""
+        if not self.service_seconds:
+            return 1
+        mean = sum(self.service_seconds) / len(self.service_seconds)
+        return max(1, min(60, math.ceil(mean * (self.waiting + 1) / self.limit)))
+
+    def summary(self) -> dict:
+        queue_ms = sorted(self.queue_ms)
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_deadline": self.rejected_deadline,
+            "queue_ms_p50": round(queue_ms[len(queue_ms) // 2], 2) if queue_ms else None,
+            "queue_ms_p95": round(queue_ms[int(len(queue_ms) * 0.95)], 2) if queue_ms else None,
+        }
 
-app = FastAPI(title="JonguBooks API", version="1.0.0")
+admission_pools = {
+    "ai": AdmissionPool("AI", AI_MAX_CONCURRENCY, AI_MAX_QUEUE, AI_QUEUE_DEADLINE_SECONDS),
+    "crud": AdmissionPool("CRUD", CRUD_MAX_CONCURRENCY, CRUD_MAX_QUEUE, CRUD_QUEUE_DEADLINE_SECONDS),
+}
+
+def admission_pool_for(method: str, path: str) -> Optional[str]:
+    if method == "OPTIONS" or not path.startswith("/api/"):
+        return None
+    if path.startswith("/api/gpt/generate") or path == "/api/gpt/accept_page":
+        return "ai"
+    return "crud"
+
+class AdmissionControlMiddleware:
+    """Admit each API request into its pool or shed it with a fast 503"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        pool_name = admission_pool_for(scope.get("method", ""), scope.get("path", "")) if scope["type"] == "http" else None
+        if not ADMISSION_CONTROL or pool_name is None:
+            await self.app(scope, receive, send)
+            return
+        pool = admission_pools[pool_name]
+        reason = await pool.acquire()
+        if reason:
+            response = JSONResponse(
+                {"detail": f"{reason}, please retry shortly"},
+                status_code=503,
+                headers={"Retry-After": str(pool.retry_after())},
+            )
+            await response(scope, receive, send)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            pool.release(time.perf_counter() - started)
+
+# On-demand sampling profiler. Nothing runs unless an admin asks for a
+# profile, so the only cost on normal requests is one header scan.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_INTERVAL_MS = 5
+PROFILE_MAX_SECONDS = 60
+PROFILE_KEEP = 20          # per-request profiles kept for download
+
+profile_lock = threading.Lock()    # one sampler at a time per worker
+request_profiles: "OrderedDict[str, Counter]" = OrderedDict()
+
+def is_admin_token(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN) and bool(token) and secrets.compare_digest(token, ADMIN_TOKEN)
+
+async def require_admin(request: Request):
+    """Admin routes look like they don't exist unless the admin token is sent"""
+    if not is_admin_token(request.headers.get("X-Admin-Token")):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+class StackSampler:
+    """Samples the Python stacks of every other thread at a fixed interval"""
+
+    def __init__(self, interval_ms: float = PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.counts: Counter = Counter()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.counts[tuple(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self) -> Counter:
+        self.stop_event.set()
+        self.thread.join()
+        return self.counts
+
+def profile_to_collapsed(counts: Counter) -> str:
+    """Brendan Gregg's collapsed-stack format, as read by flamegraph.pl and speedscope"""
+    return "\n".join(f"{';'.join(stack)} {count}" for stack, count in counts.most_common()) + "\n"
+
+def profile_to_speedscope(counts: Counter, name: str, interval_ms: float = PROFILE_INTERVAL_MS) -> dict:
+    frames, frame_index, samples, weights = [], {}, [], []
+    for stack, count in counts.most_common():
+        indices = []
+        for frame_name in stack:
+            if frame_name not in frame_index:
+                frame_index[frame_name] = len(frames)
+                frames.append({"name": frame_name})
+            indices.append(frame_index[frame_name])
+        samples.append(indices)
+        weights.append(count * interval_ms)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
+
+class ProfilingMiddleware:
+    """Profile a single request when an admin sends X-Profile: 1.
+
+    The sampler sees every thread in the worker, so run this against a
+    quiet worker to keep other requests out of the profile. The profile is
+    kept under the X-Profile-Id response header for download.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (b"x-profile", b"1") not in scope["headers"]:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        token = headers.get(b"x-admin-token", b"").decode("latin-1")
+        if not is_admin_token(token) or not profile_lock.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = str(uuid.uuid4())
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]}
+            await send(message)
+
+        sampler = StackSampler().start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            request_profiles[profile_id] = sampler.stop()
+            profile_lock.release()
+            while len(request_profiles) > PROFILE_KEEP:
+                request_profiles.popitem(last=False)
+
+if ADMIN_TOKEN:
+    app.add_middleware(ProfilingMiddleware)
+app.add_middleware(AdmissionControlMiddleware)
 
 # CORS for frontend
 app.add_middleware(
@@ -53,6 +377,8 @@ class StoryGenerationRequest(BaseModel):
     coreMessage: Optional[str] = ""
     age: Optional[str] = ""
     tone: Optional[str] = ""
+    story_id: Optional[str] = None
+    story_version: Optional[int] = None
     story_context: Optional[dict] = None
 
 class StoryFoundationRequest(BaseModel):
@@ -60,6 +386,8 @@ class StoryFoundationRequest(BaseModel):
     coreMessage: Optional[str] = ""
     age: Optional[str] = ""
     tone: Optional[str] = ""
+    story_id: Optional[str] = None
+    story_version: Optional[int] = None
     story_context: Optional[dict] = None
 
 class ImageGenerationRequest(BaseModel):
@@ -83,31 +411,60 @@ class Story(BaseModel):
     created_at: Optional[datetime] = None
     status: str = "draft"
     author: Optional[str] = "Anonymous"
+    version: int = 1
 
+# Generation requests can name a stored story (story_id, optionally pinned
+# to story_version) instead of shipping the whole story_context inline.
 class PageTextGenerationRequest(BaseModel):
-    story_title: str
-    core_message: str
+    story_title: Optional[str] = ""
+    core_message: Optional[str] = ""
     page_number: int
-    total_pages: Optional[int]
+    total_pages: Optional[int] = None
     previous_text: Optional[str] = None
+    story_id: Optional[str] = None
+    story_version: Optional[int] = None
     story_context: Optional[dict] = None
 
 class AllPagesGenerationRequest(BaseModel):
-    story_title: str
-    core_message: str
+    story_title: Optional[str] = ""
+    core_message: Optional[str] = ""
     total_pages: Optional[int] = 12
     age: Optional[str] = "4-6 years"
     tone: Optional[str] = "Gentle & Nurturing"
+    story_id: Optional[str] = None
+    story_version: Optional[int] = None
     story_context: Optional[dict] = None
 
 class PageImageGenerationRequest(BaseModel):
-    story_context: dict
     page_number: int
+    story_id: Optional[str] = None
+    story_version: Optional[int] = None
+    story_context: Optional[dict] = None
+
+class PageAcceptRequest(BaseModel):
+    story_id: str
+    page_number: int
+    speculate: bool = True
+
+class RecommendRequest(BaseModel):
+    queries: List[str] = []      # themes or free text, e.g. "It's okay to be different"
+    story_ids: List[str] = []    # find stories similar to these
+    k: int = 5
+
+PORTRAIT_BATCH_MAX_CHARACTERS = 12  # the quota is checked per portrait, but cap the fan-out too
+
+class CharacterPortraitBatchRequest(BaseModel):
+    story_id: Optional[str] = None
+    characters: List[Character] = Field(default=[], max_length=PORTRAIT_BATCH_MAX_CHARACTERS)
+    story_context: Optional[dict] = None
 
 # In-memory storage (replace with PostgreSQL later)
 stories = {}
-# Create a dummy story for development
-if not stories:
+
+def seed_dummy_story():
+    """Create a dummy story for development"""
+    if stories:
+        return
     dummy_id = str(uuid.uuid4())
     stories[dummy_id] = Story(
         id=dummy_id,
@@ -127,6 +484,900 @@ if not stories:
         created_at=datetime.now()
     )
 
+# Parsed story_context per story id: {story_id: (version, context)}
+story_context_cache: Dict[str, tuple] = {}
+# Rendered /s/ reader pages, least recently read first: {story_id: (version, etag, body)}
+reader_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+def forget_cached_story(story_id: str):
+    """Drop everything derived from a story, including pending speculation, after it changes or is deleted"""
+    story_context_cache.pop(story_id, None)
+    reader_cache.pop(story_id, None)
+    for key in [key for key in speculation_cache if key[0] == story_id]:
+        speculation_cache.pop(key)["task"].cancel()
+        speculation_stats.record_discard()
+
+def mark_story_changed(story_id: str):
+    """Bump a stored story's version and drop its cached context"""
+    if story_id in stories:
+        stories[story_id].version += 1
+        recommend_index.update(stories[story_id])
+    forget_cached_story(story_id)
+
+def story_to_context(story: Story) -> dict:
+    """Build the same story_context dict the frontend sends from a stored story"""
+    context = {
+        "title": story.title,
+        "coreMessage": story.coreMessage,
+        "outline": story.outline,
+        "storyTone": story.tone,
+        "targetAge": story.age,
+        "age": story.age,
+        "characters": [
+            {
+                "name": char.name,
+                "type": char.type,
+                "personality": char.personality,
+                "visualDescription": char.visual_description or "",
+                "role": char.role,
+            }
+            for char in story.characters
+        ],
+        "pages": [
+            {
+                "pageNumber": page.page_number,
+                "text": page.text,
+                "illustrationPrompt": page.illustration_prompt or "",
+                "imageUrl": page.illustration_url or "",
+            }
+            for page in story.pages
+        ],
+    }
+    # Prompt builders fall back to their own defaults when these are absent
+    if story.totalWords:
+        context["totalWords"] = story.totalWords
+    if story.totalPages:
+        context["totalPages"] = story.totalPages
+    return context
+
+def get_story_context(story_id: str) -> dict:
+    """Return the cached context for a stored story, rebuilding it after edits.
+
+    The returned dict is shared between requests and must not be mutated.
+    """
+    story = stories[story_id]
+    cached = story_context_cache.get(story_id)
+    if cached and cached[0] == story.version:
+        return cached[1]
+    context = story_to_context(story)
+    story_context_cache[story_id] = (story.version, context)
+    return context
+
+def resolve_story_context(story_id: Optional[str], story_version: Optional[int], inline_context: Optional[dict]) -> Optional[dict]:
+    """Prefer the stored story's context, falling back to the inline one"""
+    if not story_id:
+        return inline_context
+    if story_id not in stories:
+        raise HTTPException(status_code=404, detail="Story not found")
+    if story_version is not None and story_version != stories[story_id].version:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Story has changed (version {stories[story_id].version}, request was for {story_version})"
+        )
+    return get_story_context(story_id)
+
+# Story recommendations: every story gets a hashed n-gram vector built from
+# its title, coreMessage, outline and page text. Vectors live in a
+# memory-mapped float32 matrix, one row per story, kept current by the story
+# write paths. Cosine similarity against the whole library is a blocked
+# matrix product.
+RECOMMEND_DIMENSIONS = int(os.getenv("RECOMMEND_DIMENSIONS", "256"))
+RECOMMEND_INDEX_DIR = os.getenv("RECOMMEND_INDEX_DIR", "data")
+RECOMMEND_BLOCK_ROWS = 32768   # rows scored per matrix product, bounds scratch memory
+RECOMMEND_MAX_K = 50
+RECOMMEND_MAX_QUERIES = 32
+RECOMMEND_FIELD_WEIGHTS = (("title", 2.0), ("coreMessage", 3.0), ("outline", 1.5))
+
+RECOMMEND_PUNCTUATION = str.maketrans(string.punctuation + "—–‘’“”…", " " * (len(string.punctuation) + 7))
+RECOMMEND_STOPWORDS = frozenset("""
+a an and are as at be but by for from had has have he her him his i in into is it its
+me my of on or our she so than that the their them then there they this to up was we
+were what when where which who will with you your s t can do does did not no
+""".split())
+
+@functools.lru_cache(maxsize=65536)
+def recommendation_term(word: str) -> Optional[str]:
+    """Normalise one lowercased word: None for stopwords, plural 's' stripped"""
+    if word in RECOMMEND_STOPWORDS:
+        return None
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+def recommendation_terms(text: str) -> List[str]:
+    return [term for term in map(recommendation_term, text.lower().translate(RECOMMEND_PUNCTUATION).split()) if term]
+
+def recommendation_vector(fields):
+    """Hash (text, weight) fields into one L2-normalised vector.
+
+    Features are words and adjacent word pairs, weighted by 1 + log(count)
+    within each field. A second hash bit picks each feature's sign, so
+    colliding features tend to cancel instead of piling up.
+    """
+    import numpy as np
+    hashes, values = [], []
+    for text, field_weight in fields:
+        if not text:
+            continue
+        words = recommendation_terms(text)
+        counts = Counter(words)
+        counts.update(map(" ".join, zip(words, words[1:])))
+        hashes.append(np.fromiter(map(zlib.crc32, map(str.encode, counts)), dtype=np.uint32, count=len(counts)))
+        values.append(field_weight * (1.0 + np.log(np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))))
+    if not hashes:
+        return np.zeros(RECOMMEND_DIMENSIONS, dtype=np.float32)
+    hashes = np.concatenate(hashes)
+    values = np.concatenate(values)
+    values[hashes & 0x80000000 != 0] *= -1
+    vector = np.bincount(hashes % RECOMMEND_DIMENSIONS, weights=values, minlength=RECOMMEND_DIMENSIONS)
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector.astype(np.float32)
+
+def story_recommendation_vector(story: Story):
+    fields = [(getattr(story, name), weight) for name, weight in RECOMMEND_FIELD_WEIGHTS]
+    fields.append((" ".join(page.text for page in story.pages), 1.0))
+    return recommendation_vector(fields)
+
+def story_recommendation_vectors(batch: List[Story]):
+    """Stacked vectors for a batch of stories; pure, so it can run in a worker thread"""
+    import numpy as np
+    if not batch:
+        return np.zeros((0, RECOMMEND_DIMENSIONS), dtype=np.float32)
+    return np.stack([story_recommendation_vector(story) for story in batch])
+
+class RecommendationIndex:
+    """Hashed n-gram vectors for every story in a memory-mapped matrix.
+
+    Rows are unit length, so cosine similarity is a dot product. A deleted
+    story's row is zeroed and reused, and the file doubles when it fills up.
+    The index is built in the background during warm-up (requests that
+    arrive first wait for that build) and then updated by the story write
+    paths, which all run on the event loop. Stories themselves are only
+    kept in memory, so each worker builds its own file and removes it on
+    shutdown.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = None
+        self.matrix = None
+        self.live = None
+        self.rows: Dict[str, int] = {}
+        self.row_ids: List[Optional[str]] = []
+        self.free_rows: List[int] = []
+        self.size = 0
+        self.build_task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.matrix is not None
+
+    def ensure_built(self):
+        """Index every stored story, if that hasn't happened yet; blocks, so only for use off the server"""
+        if self.ready:
+            return
+        started = time.perf_counter()
+        self._allocate()
+        self.update_many(list(stories.values()))
+        print(f"Recommendation index built: {len(self.rows)} stories in {time.perf_counter() - started:.2f}s")
+
+    async def build(self):
+        """Index every stored story, vectorizing a snapshot in a worker thread.
+
+        Stories written while the thread runs are re-indexed from the live
+        dict afterwards; everything that touches the matrix stays on the loop.
+        """
+        if self.ready:
+            return
+        started = time.perf_counter()
+        snapshot = [(story, story.version) for story in stories.values()]
+        batch = [story for story, _ in snapshot]
+        vectors = await asyncio.to_thread(story_recommendation_vectors, batch)
+        if self.ready:
+            return
+        unchanged = [i for i, (story, version) in enumerate(snapshot)
+                     if stories.get(story.id) is story and story.version == version]
+        self._allocate()
+        self.update_many([batch[i] for i in unchanged], vectors[unchanged])
+        indexed = {batch[i].id for i in unchanged}
+        self.update_many([story for story_id, story in stories.items() if story_id not in indexed])
+        print(f"Recommendation index built: {len(self.rows)} stories in {time.perf_counter() - started:.2f}s")
+
+    async def wait_built(self):
+        """Wait for the index, starting the background build if it isn't running"""
+        if self.ready:
+            return
+        if self.build_task is None or self.build_task.done():
+            self.build_task = asyncio.create_task(self.build())
+        await asyncio.shield(self.build_task)
+
+    def _allocate(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"recommend-{os.getpid()}.f32")
+        open(self.path, "wb").close()
+        capacity = 1024
+        while capacity < len(stories):
+            capacity *= 2
+        self._resize(capacity)
+
+    def _resize(self, capacity: int):
+        import numpy as np
+        if self.matrix is not None:
+            self.matrix.flush()
+        os.truncate(self.path, capacity * RECOMMEND_DIMENSIONS * 4)
+        self.matrix = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, RECOMMEND_DIMENSIONS))
+        live = np.zeros(capacity, dtype=bool)
+        if self.live is not None:
+            live[:len(self.live)] = self.live
+        self.live = live
+        self.row_ids.extend([None] * (capacity - len(self.row_ids)))
+
+    def _row_for(self, story_id: str) -> int:
+        row = self.rows.get(story_id)
+        if row is not None:
+            return row
+        if self.free_rows:
+            row = self.free_rows.pop()
+        else:
+            if self.size == len(self.live):
+                self._resize(len(self.live) * 2)
+            row = self.size
+            self.size += 1
+        self.rows[story_id] = row
+        self.row_ids[row] = story_id
+        self.live[row] = True
+        return row
+
+    def update(self, story: Story):
+        if self.ready:
+            self.matrix[self._row_for(story.id)] = story_recommendation_vector(story)
+
+    def vectorize(self, batch):
+        """Vectors for a batch of stories, or None while the index is not built; safe off the event loop"""
+        if not self.ready or not batch:
+            return None
+        return story_recommendation_vectors(batch)
+
+    def update_many(self, batch, vectors=None):
+        """Index a batch of stories with a single write into the matrix"""
+        import numpy as np
+        if not self.ready or not batch:
+            return
+        if vectors is None:
+            vectors = self.vectorize(batch)
+        rows = np.fromiter((self._row_for(story.id) for story in batch), dtype=np.int64, count=len(batch))
+        self.matrix[rows] = vectors
+
+    def remove(self, story_id: str):
+        row = self.rows.pop(story_id, None) if self.ready else None
+        if row is None:
+            return
+        self.matrix[row] = 0.0
+        self.live[row] = False
+        self.row_ids[row] = None
+        self.free_rows.append(row)
+
+    def vector_for(self, story_id: str):
+        return self.matrix[self.rows[story_id]]
+
+    def search(self, queries, k: int, exclude: List[Optional[str]]) -> List[List[tuple]]:
+        """Top-k (story_id, score) per query row, scanning the matrix in blocks"""
+        import numpy as np
+        queries = np.asarray(queries, dtype=np.float32)
+        exclude_rows = [self.rows.get(story_id, -1) if story_id else -1 for story_id in exclude]
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, self.size, RECOMMEND_BLOCK_ROWS):
+            stop = min(start + RECOMMEND_BLOCK_ROWS, self.size)
+            scores = queries @ self.matrix[start:stop].T
+            scores[:, ~self.live[start:stop]] = -np.inf
+            for i, row in enumerate(exclude_rows):
+                if start <= row < stop:
+                    scores[i, row - start] = -np.inf
+            keep = min(k, stop - start)
+            top = np.argpartition(scores, -keep, axis=1)[:, -keep:]
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            best_rows = np.concatenate([best_rows, top + start], axis=1)
+
+        results = []
+        order = np.argsort(-best_scores, axis=1)[:, :k]
+        for i in range(len(queries)):
+            matches = []
+            for j in order[i]:
+                score = float(best_scores[i, j])
+                if score <= 0:
+                    break
+                matches.append((self.row_ids[best_rows[i, j]], score))
+            results.append(matches)
+        return results
+
+    def close(self):
+        if self.build_task is not None:
+            self.build_task.cancel()
+        if self.path:
+            self.matrix = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+recommend_index = RecommendationIndex(RECOMMEND_INDEX_DIR)
+
+# Usage accounting and quotas
+QUOTA_DAILY_TOKENS = int(os.getenv("QUOTA_DAILY_TOKENS", "200000"))  # per user, 0 = unlimited
+QUOTA_DAILY_IMAGES = int(os.getenv("QUOTA_DAILY_IMAGES", "50"))      # per user, 0 = unlimited
+# Every client IP is metered too. Raise these where many users share an IP (schools, offices)
+QUOTA_IP_DAILY_TOKENS = int(os.getenv("QUOTA_IP_DAILY_TOKENS", str(QUOTA_DAILY_TOKENS)))
+QUOTA_IP_DAILY_IMAGES = int(os.getenv("QUOTA_IP_DAILY_IMAGES", str(QUOTA_DAILY_IMAGES)))
+USAGE_STORE_PATH = os.getenv("USAGE_STORE_PATH", "data/usage.json")
+USAGE_FLUSH_SECONDS = int(os.getenv("USAGE_FLUSH_SECONDS", "10"))
+# Behind a reverse proxy, read the client IP from this header (e.g. X-Forwarded-For)
+CLIENT_IP_HEADER = os.getenv("CLIENT_IP_HEADER", "")
+# Proxies in front of the app that append to CLIENT_IP_HEADER; earlier entries are client-supplied
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "1"))
+
+# Usage keys the current request is billed to, IP key first; set by enforce_quota
+current_usage_keys: ContextVar[tuple] = ContextVar("current_usage_keys", default=("anonymous",))
+
+def empty_usage() -> dict:
+    return {"tokens": 0, "images": 0, "models": {}}
+
+def merge_usage(totals: Dict[str, dict], delta: Dict[str, dict]):
+    """Add per-user usage counters from delta into totals"""
+    for user, usage in delta.items():
+        target = totals.setdefault(user, empty_usage())
+        target["tokens"] += usage["tokens"]
+        target["images"] += usage["images"]
+        for model, counts in usage["models"].items():
+            model_totals = target["models"].setdefault(model, dict.fromkeys(counts, 0))
+            for name, value in counts.items():
+                model_totals[name] = model_totals.get(name, 0) + value
+
+class UsageTracker:
+    """In-memory per-user, per-model usage counters for the current UTC day.
+
+    Upstream responses are recorded from worker threads, so every update
+    takes the lock. Each uvicorn worker keeps the usage it recorded since
+    its last flush in `pending`. A flush merges that into USAGE_STORE_PATH
+    under a file lock and reloads the merged totals. Every worker therefore
+    enforces quotas against all workers' usage, up to one flush interval
+    stale.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.day = self.today()
+        self.users: Dict[str, dict] = {}
+        self.pending: Dict[str, dict] = {}
+
+    @staticmethod
+    def today() -> str:
+        return datetime.utcnow().strftime("%Y-%m-%d")
+
+    def _roll_day(self):
+        # Caller holds the lock
+        day = self.today()
+        if day != self.day:
+            self.day = day
+            self.users = {}
+            self.pending = {}
+
+    def _usage_records(self, user: str) -> List[dict]:
+        """The user's totals and pending usage (caller holds the lock)"""
+        self._roll_day()
+        return [self.users.setdefault(user, empty_usage()), self.pending.setdefault(user, empty_usage())]
+
+    def record_chat(self, users, model: str, prompt_tokens: int, completion_tokens: int):
+        with self.lock:
+            for user in users:
+                for usage in self._usage_records(user):
+                    totals = usage["models"].setdefault(model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "images": 0})
+                    totals["requests"] += 1
+                    totals["prompt_tokens"] += prompt_tokens
+                    totals["completion_tokens"] += completion_tokens
+                    usage["tokens"] += prompt_tokens + completion_tokens
+
+    def record_images(self, users, model: str, count: int):
+        with self.lock:
+            for user in users:
+                for usage in self._usage_records(user):
+                    totals = usage["models"].setdefault(model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "images": 0})
+                    totals["requests"] += 1
+                    totals["images"] += count
+                    usage["images"] += count
+
+    def over_quota(self, users) -> Optional[str]:
+        """Return a reason if any of the usage keys has used up a daily quota, else None"""
+        if self.day != self.today():
+            return None
+        for user in users:
+            usage = self.users.get(user)
+            if not usage:
+                continue
+            token_limit, image_limit = quota_limits(user)
+            if token_limit and usage["tokens"] >= token_limit:
+                return "Daily AI text quota reached"
+            if image_limit and usage["images"] >= image_limit:
+                return "Daily AI image quota reached"
+        return None
+
+    def usage_for(self, user: str) -> dict:
+        with self.lock:
+            self._roll_day()
+            usage = json.loads(json.dumps(self.users.get(user, empty_usage())))
+        token_limit, image_limit = quota_limits(user)
+        return {
+            "day": self.day,
+            "usage": usage,
+            "limits": {"tokens": token_limit, "images": image_limit}
+        }
+
+    def _read_store(self) -> Dict[str, dict]:
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"Could not load usage store: {e}")
+            return {}
+        return saved.get("users", {}) if saved.get("day") == self.today() else {}
+
+    def load(self):
+        self.flush()
+
+    def flush(self):
+        """Merge this worker's pending usage into the store and pick up everyone else's"""
+        with self.lock:
+            self._roll_day()
+            day, pending = self.day, self.pending
+            self.pending = {}
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".lock", "w") as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                stored = self._read_store()
+                if pending:
+                    merge_usage(stored, pending)
+                    tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "w") as f:
+                        json.dump({"day": day, "users": stored}, f)
+                    os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Could not write usage store: {e}")
+            with self.lock:
+                if self.day == day:
+                    merge_usage(self.pending, pending)
+            return
+        with self.lock:
+            if self.day == day:
+                # Usage recorded while the store was being written is still pending
+                merge_usage(stored, self.pending)
+                self.users = stored
+
+usage_tracker = UsageTracker(USAGE_STORE_PATH)
+
+async def flush_usage_periodically():
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_SECONDS)
+        await asyncio.to_thread(usage_tracker.flush)
+
+def quota_limits(user: str) -> tuple:
+    """(daily tokens, daily images) for a usage key: per-IP or per-user"""
+    if "/" in user:
+        return QUOTA_DAILY_TOKENS, QUOTA_DAILY_IMAGES
+    return QUOTA_IP_DAILY_TOKENS, QUOTA_IP_DAILY_IMAGES
+
+def get_client_ip(request: Request) -> str:
+    """The caller's IP, taken from CLIENT_IP_HEADER when the app runs behind a proxy"""
+    if CLIENT_IP_HEADER:
+        forwarded = request.headers.get(CLIENT_IP_HEADER)
+        if forwarded:
+            hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+            if hops:
+                # Only the entries our own proxies appended can be trusted
+                return hops[-min(TRUSTED_PROXY_COUNT, len(hops))][:64]
+    return request.client.host if request.client else "unknown"
+
+def get_usage_keys(request: Request) -> tuple:
+    """Usage keys for the caller until real authentication exists.
+
+    The client IP is always metered. X-User-Id / X-Session-Id only add a
+    sub-key under that IP, so new header values can't buy a fresh quota.
+    """
+    ip_key = f"ip:{get_client_ip(request)}"
+    user = request.headers.get("X-User-Id") or request.headers.get("X-Session-Id")
+    if user:
+        return (ip_key, f"{ip_key}/user:{user[:64]}")
+    return (ip_key,)
+
+async def enforce_quota(request: Request):
+    """Reject over-quota callers before any upstream call is made"""
+    keys = get_usage_keys(request)
+    current_usage_keys.set(keys)
+    reason = usage_tracker.over_quota(keys)
+    if reason:
+        now = datetime.utcnow()
+        seconds_left = 86400 - (now.hour * 3600 + now.minute * 60 + now.second)
+        raise HTTPException(status_code=429, detail=reason, headers={"Retry-After": str(seconds_left)})
+
+# Latency-aware routing between chat models
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "true").lower() == "true"
+ROUTING_LATENCY_BUDGET_MS = int(os.getenv("ROUTING_LATENCY_BUDGET_MS", "0"))  # 0 = no default budget
+ROUTING_WINDOW_SECONDS = 120      # observations older than this are forgotten
+ROUTING_WINDOW_SIZE = 50          # most recent calls kept per model and request size
+ROUTING_MIN_SAMPLES = 10          # calls needed before a model's numbers are trusted
+ROUTING_MAX_ERROR_RATE = 0.25     # above this a model is treated as degraded
+ROUTING_LARGE_PROMPT_TOKENS = 1500
+ROUTING_ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("ROUTING_ATTEMPT_TIMEOUT_SECONDS", "60"))  # per-model cap
+ROUTING_MIN_ATTEMPT_SECONDS = 0.1  # never give an attempt less than this, even over budget
+CHAT_MODEL_ALTERNATES = {"gpt-4o": "gpt-3.5-turbo", "gpt-3.5-turbo": "gpt-4o"}
+CHAT_MODEL_CONTEXT_TOKENS = {"gpt-4o": 128000, "gpt-3.5-turbo": 16385}
+
+# Per-request latency budget from the X-Latency-Budget-Ms header
+latency_budget_ms: ContextVar[Optional[int]] = ContextVar("latency_budget_ms", default=None)
+
+async def read_latency_budget(request: Request):
+    budget = request.headers.get("X-Latency-Budget-Ms")
+    latency_budget_ms.set(int(budget) if budget and budget.isdigit() else None)
+
+# Dependencies shared by every AI generation route
+AI_ROUTE_DEPENDENCIES = [Depends(enforce_quota), Depends(read_latency_budget)]
+
+class ModelHealth:
+    """Rolling latency and error observations per chat model.
+
+    Latencies are kept separately for small and large prompts, since a
+    large prompt is slow on any model and shouldn't make it look degraded.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: Dict[tuple, deque] = {}
+
+    def _recent(self, model: str, large: bool) -> list:
+        # Caller holds the lock
+        calls = self.calls.get((model, large))
+        if not calls:
+            return []
+        cutoff = time.monotonic() - ROUTING_WINDOW_SECONDS
+        while calls and calls[0][0] < cutoff:
+            calls.popleft()
+        return list(calls)
+
+    def record(self, model: str, large: bool, latency_ms: float, ok: bool):
+        with self.lock:
+            key = (model, large)
+            if key not in self.calls:
+                self.calls[key] = deque(maxlen=ROUTING_WINDOW_SIZE)
+            self.calls[key].append((time.monotonic(), latency_ms, ok))
+
+    def p95_ms(self, model: str, large: bool) -> Optional[float]:
+        with self.lock:
+            latencies = sorted(latency for _, latency, ok in self._recent(model, large) if ok)
+        if len(latencies) < ROUTING_MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, math.ceil(len(latencies) * 0.95) - 1)]
+
+    def error_rate(self, model: str) -> Optional[float]:
+        with self.lock:
+            outcomes = [ok for large in (False, True) for _, _, ok in self._recent(model, large)]
+        if len(outcomes) < ROUTING_MIN_SAMPLES:
+            return None
+        return 1 - sum(outcomes) / len(outcomes)
+
+    def degraded(self, model: str) -> bool:
+        rate = self.error_rate(model)
+        return rate is not None and rate > ROUTING_MAX_ERROR_RATE
+
+    def summary(self) -> dict:
+        return {
+            model: {
+                "p95_ms_small": self.p95_ms(model, False),
+                "p95_ms_large": self.p95_ms(model, True),
+                "error_rate": self.error_rate(model),
+                "degraded": self.degraded(model),
+            }
+            for model in CHAT_MODEL_ALTERNATES
+        }
+
+model_health = ModelHealth()
+
+def estimate_prompt_tokens(messages: List[dict]) -> int:
+    # ~4 characters per token is close enough for routing decisions
+    return sum(len(message.get("content") or "") for message in messages) // 4
+
+def route_chat_models(preferred: str, prompt_tokens: int) -> List[str]:
+    """Order the models to try for a chat call, best first.
+
+    The endpoint's preferred model wins unless it is degraded or its recent
+    p95 would blow the caller's latency budget and the alternate wouldn't.
+    The other model is kept as a fallback if the first attempt fails.
+    """
+    alternate = CHAT_MODEL_ALTERNATES.get(preferred)
+    if not MODEL_ROUTING or not alternate:
+        return [preferred]
+    candidates = [
+        model for model in (preferred, alternate)
+        if prompt_tokens < CHAT_MODEL_CONTEXT_TOKENS.get(model, 0) * 0.8
+    ] or [preferred]
+    if len(candidates) == 1:
+        return candidates
+
+    healthy = [model for model in candidates if not model_health.degraded(model)] or candidates
+    first = healthy[0]
+    budget = latency_budget_ms.get() or ROUTING_LATENCY_BUDGET_MS
+    if budget and len(healthy) > 1:
+        large = prompt_tokens >= ROUTING_LARGE_PROMPT_TOKENS
+        p95 = {model: model_health.p95_ms(model, large) for model in healthy}
+        if p95[first] is not None and p95[first] > budget:
+            fastest = min(healthy, key=lambda model: p95[model] if p95[model] is not None else math.inf)
+            if p95[fastest] is not None and p95[fastest] < p95[first]:
+                first = fastest
+    return [first] + [model for model in candidates if model != first]
+
+def is_retryable(error: Exception) -> bool:
+    """Server-side and rate-limit errors are worth retrying on another model"""
+    status = getattr(error, "status_code", None)
+    return status is None or status == 429 or status >= 500
+
+def is_timeout(error: Exception) -> bool:
+    from openai import APITimeoutError
+    return isinstance(error, APITimeoutError)
+
+# Rough list prices in US cents, only used to budget speculative work
+MODEL_PRICES_CENTS = {
+    "gpt-4o": {"prompt": 0.00025, "completion": 0.001},
+    "gpt-3.5-turbo": {"prompt": 0.00005, "completion": 0.00015},
+    "dall-e-3": {"image": 4.0},
+}
+
+# Set inside speculative tasks to collect what their upstream calls cost
+speculation_cost: ContextVar[Optional[list]] = ContextVar("speculation_cost", default=None)
+
+def record_spend(model: str, prompt_tokens: int = 0, completion_tokens: int = 0, images: int = 0):
+    prices = MODEL_PRICES_CENTS.get(model, {})
+    cents = (
+        prompt_tokens * prices.get("prompt", 0)
+        + completion_tokens * prices.get("completion", 0)
+        + images * prices.get("image", 0)
+    )
+    speculation_stats.record_spend(cents, speculation_cost.get())
+
+def create_chat_completion(**kwargs):
+    """Call the chat API on the best available model and bill the tokens to the current user"""
+    prompt_tokens = estimate_prompt_tokens(kwargs.get("messages", []))
+    large = prompt_tokens >= ROUTING_LARGE_PROMPT_TOKENS
+    attempts = route_chat_models(kwargs.get("model", "unknown"), prompt_tokens)
+    budget = latency_budget_ms.get() or ROUTING_LATENCY_BUDGET_MS
+    deadline = time.perf_counter() + budget / 1000 if budget else None
+    for attempt, model in enumerate(attempts):
+        started = time.perf_counter()
+        # Leave the rest of the budget to the models still to come
+        timeout = ROUTING_ATTEMPT_TIMEOUT_SECONDS
+        if deadline is not None:
+            share = (deadline - started) / (len(attempts) - attempt)
+            timeout = min(timeout, max(share, ROUTING_MIN_ATTEMPT_SECONDS))
+        options = {"timeout": timeout}
+        if len(attempts) > 1:
+            # The router owns retries when it has a fallback; otherwise the SDK keeps its own
+            options["max_retries"] = 0
+        client = get_openai_client().with_options(**options)
+        try:
+            response = client.chat.completions.create(**{**kwargs, "model": model})
+        except Exception as e:
+            if not is_retryable(e):
+                # A rejected request (e.g. content policy) says nothing about the model's health
+                raise
+            if not (timeout < ROUTING_ATTEMPT_TIMEOUT_SECONDS and is_timeout(e)):
+                # Running out of one caller's budget doesn't make the model slow for everyone
+                model_health.record(model, large, (time.perf_counter() - started) * 1000, False)
+            if attempt == len(attempts) - 1:
+                raise
+            print(f"{model} failed ({e}), falling back to {attempts[attempt + 1]}")
+            continue
+        model_health.record(model, large, (time.perf_counter() - started) * 1000, True)
+        break
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    usage_tracker.record_chat(current_usage_keys.get(), model, prompt_tokens, completion_tokens)
+    record_spend(model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    return response
+
+def create_image(**kwargs):
+    """Call the image API and bill the images to the current user"""
+    response = get_openai_client().images.generate(**kwargs)
+    model = kwargs.get("model", "unknown")
+    usage_tracker.record_images(current_usage_keys.get(), model, kwargs.get("n", 1))
+    record_spend(model, images=kwargs.get("n", 1))
+    return response
+
+# Speculative prefetch of the next page
+SPECULATIVE_PREFETCH = os.getenv("SPECULATIVE_PREFETCH", "false").lower() == "true"
+SPECULATION_TTL_SECONDS = int(os.getenv("SPECULATION_TTL_SECONDS", "300"))
+SPECULATION_MAX_SHARE = float(os.getenv("SPECULATION_MAX_SHARE", "0.2"))
+SPECULATION_MAX_ENTRIES = 1000
+# Expected cost of one speculative call, checked against the budget up front
+SPECULATION_ESTIMATE_CENTS = {"text": 0.5, "image": 4.0}
+
+class SpeculationStats:
+    """Process-wide spend and hit counters for speculative prefetch.
+
+    Speculative spend counts against the budget until its result is served;
+    a hit turns it into ordinary spend because it replaced a real call.
+    A generation's estimate is reserved when it starts and swapped for the
+    real cost when its upstream calls finish, so concurrent starts can't
+    all pass the budget check.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total_cents = 0.0
+        self.unserved_cents = 0.0
+        self.reserved_cents = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self.saved_seconds = 0.0
+
+    def record_spend(self, cents: float, speculative: Optional[list]):
+        with self.lock:
+            self.total_cents += cents
+            if speculative is not None:
+                speculative.append(cents)
+                self.unserved_cents += cents
+
+    def reserve(self, estimate_cents: float) -> bool:
+        """Hold budget for one speculative generation, if the share allows it"""
+        with self.lock:
+            unserved = self.unserved_cents + estimate_cents
+            if unserved > SPECULATION_MAX_SHARE * (self.total_cents + self.reserved_cents + estimate_cents):
+                return False
+            self.unserved_cents = unserved
+            self.reserved_cents += estimate_cents
+            return True
+
+    def release(self, estimate_cents: float):
+        """Drop a reservation once the generation's real spend has been recorded (or never happened)"""
+        with self.lock:
+            self.unserved_cents = max(0.0, self.unserved_cents - estimate_cents)
+            self.reserved_cents = max(0.0, self.reserved_cents - estimate_cents)
+
+    def record_hit(self, cost_cents: float, saved_seconds: float):
+        with self.lock:
+            self.hits += 1
+            self.unserved_cents = max(0.0, self.unserved_cents - cost_cents)
+            self.saved_seconds += saved_seconds
+
+    def record_miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def record_discard(self):
+        with self.lock:
+            self.discarded += 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "enabled": SPECULATIVE_PREFETCH,
+                "hits": self.hits,
+                "misses": self.misses,
+                "discarded": self.discarded,
+                "hit_rate": round(self.hits / requests, 3) if requests else None,
+                "saved_seconds": round(self.saved_seconds, 2),
+                "speculative_share": round(self.unserved_cents / self.total_cents, 3) if self.total_cents else 0.0,
+                "max_share": SPECULATION_MAX_SHARE,
+            }
+
+speculation_stats = SpeculationStats()
+
+# {(story_id, kind, page_number): {"version", "expires", "task", "previous_text", "cost"}}
+speculation_cache: Dict[tuple, dict] = {}
+
+def prune_speculation_cache():
+    now = time.monotonic()
+    for key in [key for key, entry in speculation_cache.items() if entry["expires"] < now]:
+        entry = speculation_cache.pop(key)
+        entry["task"].cancel()
+        speculation_stats.record_discard()
+    while len(speculation_cache) >= SPECULATION_MAX_ENTRIES:
+        oldest = min(speculation_cache, key=lambda key: speculation_cache[key]["expires"])
+        speculation_cache.pop(oldest)["task"].cancel()
+        speculation_stats.record_discard()
+
+def start_speculation(story_id: str, kind: str, page_number: int, run, previous_text: Optional[str] = None) -> bool:
+    """Run a blocking generation in the background and hold its result for the next request"""
+    key = (story_id, kind, page_number)
+    version = stories[story_id].version
+    existing = speculation_cache.get(key)
+    if existing and existing["version"] == version:
+        return True
+    estimate = SPECULATION_ESTIMATE_CENTS[kind]
+    prune_speculation_cache()
+    if not speculation_stats.reserve(estimate):
+        return False
+    cost = []
+    submitted = []
+
+    def run_if_current():
+        # Cancelling the task can't stop a thread, so check again once a worker picks this up
+        try:
+            if story_id in stories and stories[story_id].version == version:
+                return run()
+            raise RuntimeError(f"story {story_id} changed before speculation started")
+        finally:
+            speculation_stats.release(estimate)
+
+    async def speculate():
+        speculation_cost.set(cost)
+        started = time.perf_counter()
+        submitted.append(True)
+        result = await asyncio.to_thread(run_if_current)
+        return result, time.perf_counter() - started
+
+    def finished(task):
+        if not submitted:
+            speculation_stats.release(estimate)
+        if not task.cancelled():
+            task.exception()  # failures are reported when the result is taken, not as unretrieved
+
+    task = asyncio.create_task(speculate())
+    task.add_done_callback(finished)
+    speculation_cache[key] = {
+        "version": version,
+        "expires": time.monotonic() + SPECULATION_TTL_SECONDS,
+        "task": task,
+        "previous_text": previous_text,
+        "cost": cost,
+    }
+    return True
+
+async def take_speculation(story_id: Optional[str], kind: str, page_number: int, previous_text: Optional[str] = None):
+    """Return a prefetched result for this request, or None if there isn't a usable one"""
+    if not SPECULATIVE_PREFETCH or not story_id:
+        return None
+    entry = speculation_cache.pop((story_id, kind, page_number), None)
+    if entry is None:
+        speculation_stats.record_miss()
+        return None
+    stale = (
+        story_id not in stories
+        or entry["version"] != stories[story_id].version
+        or entry["expires"] < time.monotonic()
+        or (previous_text and previous_text != entry["previous_text"])
+    )
+    if stale:
+        entry["task"].cancel()
+        speculation_stats.record_discard()
+        speculation_stats.record_miss()
+        return None
+    waited = time.perf_counter()
+    try:
+        result, generation_seconds = await asyncio.shield(entry["task"])
+    except Exception as e:
+        print(f"Speculative {kind} for page {page_number} failed: {e}")
+        speculation_stats.record_miss()
+        return None
+    speculation_stats.record_hit(sum(entry["cost"]), max(0.0, generation_seconds - (time.perf_counter() - waited)))
+    return result
+
 # Serve frontend at root
 @app.get("/")
 async def serve_frontend():
@@ -138,7 +1389,9 @@ async def gpt_create_story(story: Story):
     """GPT+ calls this to create a new story"""
     story.id = str(uuid.uuid4())
     story.created_at = datetime.now()
+    story.version = 1
     stories[story.id] = story
+    recommend_index.update(story)
     
     return {
         "success": True,
@@ -154,6 +1407,7 @@ async def gpt_add_character(story_id: str, character: Character):
     
     character.id = str(uuid.uuid4())
     stories[story_id].characters.append(character)
+    mark_story_changed(story_id)
     
     return {
         "success": True,
@@ -170,6 +1424,7 @@ async def gpt_add_page(story_id: str, page: Page):
     page.id = str(uuid.uuid4())
     page.page_number = len(stories[story_id].pages) + 1
     stories[story_id].pages.append(page)
+    mark_story_changed(story_id)
     
     return {
         "success": True,
@@ -177,16 +1432,17 @@ async def gpt_add_page(story_id: str, page: Page):
         "message": f"Page {page.page_number} added!"
     }
 
-@app.post("/api/gpt/generate_characters")
+@app.post("/api/gpt/generate_characters", dependencies=AI_ROUTE_DEPENDENCIES)
 async def gpt_generate_characters(req: StoryGenerationRequest):
     """Generate character ideas using AI"""
-    if not openai.api_key:
+    if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    story_context = resolve_story_context(req.story_id, req.story_version, req.story_context)
 
     try:
         # Use story_context if provided
-        if req.story_context:
-            ctx = req.story_context
+        if story_context:
+            ctx = story_context
             prompt_parts = []
             if ctx.get('title'):
                 prompt_parts.append(f"Story Title: '{ctx['title']}'")
@@ -235,7 +1491,8 @@ async def gpt_generate_characters(req: StoryGenerationRequest):
             ]
             """
 
-        response = openai.chat.completions.create(
+        response = await asyncio.to_thread(
+            create_chat_completion,
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "You are a creative assistant for writing children's books."},
@@ -270,63 +1527,77 @@ async def gpt_generate_characters(req: StoryGenerationRequest):
         print(f"Error calling OpenAI: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to generate characters: {e}")
 
-@app.post("/api/gpt/generate_page_text")
+def build_page_text_prompt(req: PageTextGenerationRequest, story_context: Optional[dict]) -> str:
+    """Build the chat prompt for one page's text"""
+    # Use story_context if provided
+    if story_context:
+        ctx = story_context
+        prompt_parts = []
+        if ctx.get('title'):
+            prompt_parts.append(f"Story Title: '{ctx['title']}'")
+        if ctx.get('coreMessage'):
+            prompt_parts.append(f"Core Message: '{ctx['coreMessage']}'")
+        if ctx.get('storyTone'):
+            prompt_parts.append(f"Tone: {ctx['storyTone']}")
+        if ctx.get('targetAge'):
+            prompt_parts.append(f"Target Age: {ctx['targetAge']}")
+        if ctx.get('outline'):
+            prompt_parts.append(f"Outline: {ctx['outline']}")
+        if ctx.get('characters'):
+            char_descriptions = []
+            for char in ctx['characters']:
+                desc = f"Name: {char.get('name', '')}, Personality: {char.get('personality', '')}, Visual: {char.get('visualDescription', '')}"
+                char_descriptions.append(desc)
+            if char_descriptions:
+                prompt_parts.append("Characters: " + "; ".join(char_descriptions))
+        if ctx.get('pages'):
+            prompt_parts.append(f"The story has {len(ctx['pages'])} pages.")
+        if req.page_number:
+            prompt_parts.append(f"This is for page {req.page_number} of roughly {ctx.get('totalPages', ctx.get('pages') and len(ctx['pages']) or 12)} pages.")
+        if req.previous_text:
+            prompt_parts.append(f"The text of the previous page was: '{req.previous_text}'")
+        prompt = f"""
+        You are a gentle and creative author of children's books.\nBased on the following story details, write the text for the current page.\nKeep the language simple, engaging, and appropriate for a young child ({ctx.get('targetAge', '4-6 years')}).\nThe text should be a short paragraph, around 2-4 sentences.\n\nContext:\n- {' '.join(prompt_parts)}\n\nGenerate only the text for the current page.\n"""
+    else:
+        prompt_context = [
+            f"Story Title: \"{req.story_title}\"",
+            f"Core Message: \"{req.core_message}\"",
+            f"This is for page {req.page_number} of roughly {req.total_pages or '12'} pages."
+        ]
+        if req.previous_text:
+            prompt_context.append(f"The text of the previous page was: \"{req.previous_text}\"")
+        prompt = f"""
+        You are a gentle and creative author of children's books.\nBased on the following story details, write the text for the current page.\nKeep the language simple, engaging, and appropriate for a young child (4-6 years old).\nThe text should be a short paragraph, around 2-4 sentences.\n\nContext:\n- {' '.join(prompt_context)}\n\nGenerate only the text for the current page.\n"""
+    return prompt
+
+def generate_page_text(prompt: str) -> str:
+    """Call the chat API for one page's text (blocking)"""
+    response = create_chat_completion(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": "You are a creative assistant for writing children's books."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.8,
+    )
+    return response.choices[0].message.content.strip()
+
+@app.post("/api/gpt/generate_page_text", dependencies=AI_ROUTE_DEPENDENCIES)
 async def gpt_generate_page_text(req: PageTextGenerationRequest):
     """Generate text for a specific story page using AI"""
-    if not openai.api_key:
+    if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    story_context = resolve_story_context(req.story_id, req.story_version, req.story_context)
+    speculated = await take_speculation(req.story_id, "text", req.page_number, req.previous_text)
+    if speculated is not None:
+        return {
+            "success": True,
+            "data": {"text": speculated}
+        }
 
     try:
-        # Use story_context if provided
-        if req.story_context:
-            ctx = req.story_context
-            prompt_parts = []
-            if ctx.get('title'):
-                prompt_parts.append(f"Story Title: '{ctx['title']}'")
-            if ctx.get('coreMessage'):
-                prompt_parts.append(f"Core Message: '{ctx['coreMessage']}'")
-            if ctx.get('storyTone'):
-                prompt_parts.append(f"Tone: {ctx['storyTone']}")
-            if ctx.get('targetAge'):
-                prompt_parts.append(f"Target Age: {ctx['targetAge']}")
-            if ctx.get('outline'):
-                prompt_parts.append(f"Outline: {ctx['outline']}")
-            if ctx.get('characters'):
-                char_descriptions = []
-                for char in ctx['characters']:
-                    desc = f"Name: {char.get('name', '')}, Personality: {char.get('personality', '')}, Visual: {char.get('visualDescription', '')}"
-                    char_descriptions.append(desc)
-                if char_descriptions:
-                    prompt_parts.append("Characters: " + "; ".join(char_descriptions))
-            if ctx.get('pages'):
-                prompt_parts.append(f"The story has {len(ctx['pages'])} pages.")
-            if req.page_number:
-                prompt_parts.append(f"This is for page {req.page_number} of roughly {ctx.get('totalPages', ctx.get('pages') and len(ctx['pages']) or 12)} pages.")
-            if req.previous_text:
-                prompt_parts.append(f"The text of the previous page was: '{req.previous_text}'")
-            prompt = f"""
-            You are a gentle and creative author of children's books.\nBased on the following story details, write the text for the current page.\nKeep the language simple, engaging, and appropriate for a young child ({ctx.get('targetAge', '4-6 years')}).\nThe text should be a short paragraph, around 2-4 sentences.\n\nContext:\n- {' '.join(prompt_parts)}\n\nGenerate only the text for the current page.\n"""
-        else:
-            prompt_context = [
-                f"Story Title: \"{req.story_title}\"",
-                f"Core Message: \"{req.core_message}\"",
-                f"This is for page {req.page_number} of roughly {req.total_pages or '12'} pages."
-            ]
-            if req.previous_text:
-                prompt_context.append(f"The text of the previous page was: \"{req.previous_text}\"")
-            prompt = f"""
-            You are a gentle and creative author of children's books.\nBased on the following story details, write the text for the current page.\nKeep the language simple, engaging, and appropriate for a young child (4-6 years old).\nThe text should be a short paragraph, around 2-4 sentences.\n\nContext:\n- {' '.join(prompt_context)}\n\nGenerate only the text for the current page.\n"""
-
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are a creative assistant for writing children's books."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.8,
-        )
-        
-        page_text = response.choices[0].message.content.strip()
+        prompt = build_page_text_prompt(req, story_context)
+        page_text = await asyncio.to_thread(generate_page_text, prompt)
 
         return {
             "success": True,
@@ -337,16 +1608,17 @@ async def gpt_generate_page_text(req: PageTextGenerationRequest):
         print(f"Error calling OpenAI for page text: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to generate page text: {e}")
 
-@app.post("/api/gpt/generate_all_pages")
+@app.post("/api/gpt/generate_all_pages", dependencies=AI_ROUTE_DEPENDENCIES)
 async def gpt_generate_all_pages(req: AllPagesGenerationRequest):
     """Generate all pages for a story using AI"""
-    if not openai.api_key:
+    if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    story_context = resolve_story_context(req.story_id, req.story_version, req.story_context)
 
     try:
         # Use story_context if provided
-        if req.story_context:
-            ctx = req.story_context
+        if story_context:
+            ctx = story_context
             prompt_parts = []
             if ctx.get('title'):
                 prompt_parts.append(f"Story Title: '{ctx['title']}'")
@@ -425,7 +1697,8 @@ async def gpt_generate_all_pages(req: AllPagesGenerationRequest):
             ]
             """
 
-        response = openai.chat.completions.create(
+        response = await asyncio.to_thread(
+            create_chat_completion,
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": "You are a creative assistant for writing children's books."},
@@ -460,17 +1733,18 @@ async def gpt_generate_all_pages(req: AllPagesGenerationRequest):
         print(f"Error calling OpenAI for all pages: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to generate all pages: {e}")
 
-@app.post("/api/gpt/generate_story_foundation")
+@app.post("/api/gpt/generate_story_foundation", dependencies=AI_ROUTE_DEPENDENCIES)
 async def gpt_generate_story_foundation(req: StoryFoundationRequest):
     """Generate or complete a story foundation using AI"""
-    if not openai.api_key:
+    if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    story_context = resolve_story_context(req.story_id, req.story_version, req.story_context)
 
     try:
         user_prompts = []
         # Use story_context if provided
-        if req.story_context:
-            ctx = req.story_context
+        if story_context:
+            ctx = story_context
             if ctx.get('title'):
                 user_prompts.append(f"The story title is '{ctx['title']}'.")
             if ctx.get('coreMessage'):
@@ -521,7 +1795,8 @@ async def gpt_generate_story_foundation(req: StoryFoundationRequest):
         }}
         """
 
-        response = openai.chat.completions.create(
+        response = await asyncio.to_thread(
+            create_chat_completion,
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "You are a creative assistant for writing children's books."},
@@ -556,36 +1831,17 @@ async def gpt_generate_story_foundation(req: StoryFoundationRequest):
         print(f"Error calling OpenAI: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to generate story foundation: {e}")
 
-@app.post("/api/gpt/generate_image")
+@app.post("/api/gpt/generate_image", dependencies=AI_ROUTE_DEPENDENCIES)
 async def gpt_generate_image(req: ImageGenerationRequest):
     """Generate a character image using DALL-E with maximum anti-text measures"""
-    if not openai.api_key:
+    if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
 
     try:
         # Build the most effective prompt
         prompt = build_ultimate_character_prompt(req.prompt, getattr(req, "story_context", None))
         
-        # Try up to 2 times if needed
-        for attempt in range(2):
-            response = openai.images.generate(
-                model="dall-e-3",
-                prompt=prompt,
-                n=1,
-                size="1024x1024",
-                response_format="url",
-                quality="standard",  # Less detail = less chance of text
-                style="natural"      # Your insight: natural style is better
-            )
-            
-            image_url = response.data[0].url
-            
-            # Optional: Quick validation (you could implement actual text detection)
-            if not contains_obvious_text_keywords(prompt):
-                return {
-                    "success": True,
-                    "data": {"url": image_url}
-                }
+        image_url = await generate_portrait_url(prompt)
         return {
             "success": True,
             "data": {"url": image_url}
@@ -632,23 +1888,22 @@ def build_ultimate_character_prompt(character_description: str, story_context: d
     )
     return "\n".join(all_parts)
 
-@app.post("/api/gpt/generate_page_image")
+@app.post("/api/gpt/generate_page_image", dependencies=AI_ROUTE_DEPENDENCIES)
 async def gpt_generate_page_image(req: PageImageGenerationRequest):
     """Generate page illustration with maximum context and zero text"""
-    if not openai.api_key:
+    if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    story_context = resolve_story_context(req.story_id, req.story_version, req.story_context)
+    if not story_context:
+        raise HTTPException(status_code=400, detail="Either story_id or story_context is required")
+    speculated = await take_speculation(req.story_id, "image", req.page_number)
+    if speculated is not None:
+        return {
+            "success": True,
+            "data": {"url": speculated}
+        }
     try:
-        prompt = build_ultimate_page_prompt(req.story_context, req.page_number)
-        response = openai.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            n=1,
-            size="1024x1024",
-            response_format="url",
-            quality="standard",
-            style="natural"
-        )
-        image_url = response.data[0].url
+        image_url = await asyncio.to_thread(generate_page_image, story_context, req.page_number)
         return {
             "success": True,
             "data": {"url": image_url}
@@ -657,6 +1912,20 @@ async def gpt_generate_page_image(req: PageImageGenerationRequest):
         print(f"Error generating page image: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to generate page image: {e}")
 
+def generate_page_image(story_context: dict, page_number: int) -> str:
+    """Call DALL-E for one page's illustration (blocking)"""
+    prompt = build_ultimate_page_prompt(story_context, page_number)
+    response = create_image(
+        model="dall-e-3",
+        prompt=prompt,
+        n=1,
+        size="1024x1024",
+        response_format="url",
+        quality="standard",
+        style="natural"
+    )
+    return response.data[0].url
+
 def build_ultimate_page_prompt(story_context: dict, page_number: int) -> str:
     critical_rules = [
         "ABSOLUTELY NO TEXT OR WRITING OF ANY KIND in this image.",
@@ -765,13 +2034,125 @@ def get_relevant_characters_for_page(story_context: dict, current_page: dict) ->
         relevant_chars.append(story_context['characters'][0])
     return relevant_chars
 
-def contains_obvious_text_keywords(text: str) -> bool:
-    text_keywords = ['text', 'word', 'letter', 'writing', 'sign', 'book', 'page']
-    return any(keyword in text.lower() for keyword in text_keywords)
+# Text detection on generated images (OCR-free, CPU only). Thresholds were
+# tuned against the labeled portrait set in `bench.py textcheck`.
+TEXT_CHECK_SIZE = 512             # images are downscaled to this before analysis
+TEXT_CELL_SIZE = 16               # analysis grid cell, in downscaled pixels
+TEXT_EDGE_THRESHOLD = 40          # brightness step between neighbouring pixels counted as an edge
+TEXT_LONG_EDGE = 40               # straight edges this long are stripes, fences or outlines, not glyphs
+TEXT_MIN_STROKE_DENSITY = 0.1     # share of a cell's pixels on vertical glyph edges
+TEXT_MIN_CROSSBAR_DENSITY = 0.05  # share on horizontal edges, averaged along a line
+TEXT_MIN_RUN = 3                  # adjacent glyph-like cells needed to call it a line of text
+TEXT_MAX_LINE_HEIGHT = 3          # taller glyph-like regions are texture (fur, leaves, dots)
+IMAGE_TEXT_ATTEMPTS = 2           # DALL-E calls allowed per portrait when text keeps showing up
+
+image_check_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("IMAGE_CHECK_WORKERS", "2")),
+    thread_name_prefix="image-check"
+)
 
-@app.post("/api/gpt/generate_minimal_image")
+def run_lengths(mask):
+    """Length of the horizontal run of True pixels each pixel belongs to (0 where False)"""
+    import numpy as np
+    height, width = mask.shape
+    padded = np.zeros((height, width + 1), dtype=bool)
+    padded[:, :width] = mask
+    flat = padded.ravel()
+    starts = flat & ~np.concatenate(([False], flat[:-1]))
+    run_ids = np.cumsum(starts) * flat
+    lengths = np.bincount(run_ids)
+    lengths[0] = 0
+    return lengths[run_ids].reshape(height, width + 1)[:, :width]
+
+def image_contains_text(image_bytes: bytes) -> bool:
+    """Guess whether an image has lettering in it from its edge structure.
+
+    Glyphs are short strokes in both directions, packed densely along a
+    horizontal line one or two cells tall. Long straight edges (stripes,
+    fences, grass blades, shelf edges) are dropped first. Whatever dense
+    region is left must then be a wide, short run of cells. Fur, leaves and
+    polka dots fill taller regions, and soft shading has too few edges.
+    """
+    import numpy as np
+    from PIL import Image
+    image = Image.open(BytesIO(image_bytes)).convert("L")
+    image.thumbnail((TEXT_CHECK_SIZE, TEXT_CHECK_SIZE))
+    pixels = np.asarray(image, dtype=np.int16)
+
+    vertical = np.zeros(pixels.shape, dtype=bool)
+    horizontal = np.zeros(pixels.shape, dtype=bool)
+    vertical[:, 1:] = np.abs(np.diff(pixels, axis=1)) > TEXT_EDGE_THRESHOLD
+    horizontal[1:, :] = np.abs(np.diff(pixels, axis=0)) > TEXT_EDGE_THRESHOLD
+    # Widen by a pixel before measuring so slanted or wobbly lines still count as long
+    widened = vertical.copy()
+    widened[:, 1:] |= vertical[:, :-1]
+    widened[:, :-1] |= vertical[:, 1:]
+    vertical &= run_lengths(widened.T).T < TEXT_LONG_EDGE
+    widened = horizontal.copy()
+    widened[1:, :] |= horizontal[:-1, :]
+    widened[:-1, :] |= horizontal[1:, :]
+    horizontal &= run_lengths(widened) < TEXT_LONG_EDGE
+
+    rows, cols = pixels.shape[0] // TEXT_CELL_SIZE, pixels.shape[1] // TEXT_CELL_SIZE
+
+    def cell_density(edges):
+        cells = edges[:rows * TEXT_CELL_SIZE, :cols * TEXT_CELL_SIZE]
+        return cells.reshape(rows, TEXT_CELL_SIZE, cols, TEXT_CELL_SIZE).mean(axis=(1, 3))
+
+    strokes = cell_density(vertical) > TEXT_MIN_STROKE_DENSITY
+    crossbars = cell_density(horizontal)
+    region_height = run_lengths(strokes.T).T
+    for r in range(rows):
+        c = 0
+        while c < cols:
+            if not strokes[r, c]:
+                c += 1
+                continue
+            start = c
+            while c < cols and strokes[r, c]:
+                c += 1
+            if (
+                c - start >= TEXT_MIN_RUN
+                and crossbars[r, start:c].mean() > TEXT_MIN_CROSSBAR_DENSITY
+                and np.median(region_height[r, start:c]) <= TEXT_MAX_LINE_HEIGHT
+            ):
+                return True
+    return False
+
+async def image_has_text(image_url: str) -> bool:
+    """Download a generated image and run the text check off the event loop"""
+    try:
+        response = await get_http_client().get(image_url)
+        response.raise_for_status()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(image_check_pool, image_contains_text, response.content)
+    except Exception as e:
+        # Never fail a generation because the check itself failed
+        print(f"Error checking image for text: {e}")
+        return False
+
+async def generate_portrait_url(prompt: str) -> str:
+    """Generate a DALL-E portrait, regenerating only if the result contains text"""
+    for attempt in range(IMAGE_TEXT_ATTEMPTS):
+        response = await asyncio.to_thread(
+            create_image,
+            model="dall-e-3",
+            prompt=prompt,
+            n=1,
+            size="1024x1024",
+            response_format="url",
+            quality="standard",  # Less detail = less chance of text
+            style="natural"      # Your insight: natural style is better
+        )
+        image_url = response.data[0].url
+        if attempt == IMAGE_TEXT_ATTEMPTS - 1 or not await image_has_text(image_url):
+            return image_url
+        print(f"Text detected in generated image (attempt {attempt + 1}), regenerating")
+    return image_url
+
+@app.post("/api/gpt/generate_minimal_image", dependencies=AI_ROUTE_DEPENDENCIES)
 async def generate_minimal_image(req: ImageGenerationRequest):
-    if not openai.api_key:
+    if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
     try:
         minimal_prompt = f"""
@@ -782,7 +2163,8 @@ NO TEXT IN IMAGE.
 Watercolor style.
 No text anywhere.
         """
-        response = openai.images.generate(
+        response = await asyncio.to_thread(
+            create_image,
             model="dall-e-3",
             prompt=minimal_prompt.strip(),
             n=1,
@@ -798,6 +2180,73 @@ No text anywhere.
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate minimal image: {e}")
 
+@app.post("/api/gpt/accept_page", dependencies=AI_ROUTE_DEPENDENCIES)
+async def gpt_accept_page(req: PageAcceptRequest):
+    """Mark a page as accepted and, if enabled, start prefetching the next one"""
+    if req.story_id not in stories:
+        raise HTTPException(status_code=404, detail="Story not found")
+    if not (SPECULATIVE_PREFETCH and req.speculate and OPENAI_API_KEY):
+        return {"success": True, "data": {"speculating": []}}
+    if usage_tracker.over_quota(current_usage_keys.get()):
+        return {"success": True, "data": {"speculating": []}}
+
+    story_context = get_story_context(req.story_id)
+    current_page, _, next_page = get_page_context(story_context, req.page_number)
+    next_number = req.page_number + 1
+    speculating = []
+    if next_page is None or not next_page.get('text'):
+        # Same request the client will send for the next page
+        next_req = PageTextGenerationRequest(
+            page_number=next_number,
+            previous_text=(current_page or {}).get('text') or None,
+            story_id=req.story_id,
+        )
+        prompt = build_page_text_prompt(next_req, story_context)
+        if start_speculation(req.story_id, "text", next_number, lambda: generate_page_text(prompt), next_req.previous_text):
+            speculating.append("text")
+    else:
+        if start_speculation(req.story_id, "image", next_number, lambda: generate_page_image(story_context, next_number)):
+            speculating.append("image")
+    return {"success": True, "data": {"speculating": speculating}}
+
+@app.get("/api/gpt/model_health")
+async def gpt_model_health():
+    """Rolling latency and error rate per chat model, as seen by the router"""
+    return {"success": True, "data": model_health.summary()}
+
+@app.get("/api/admin/profile", dependencies=[Depends(require_admin)])
+async def admin_profile(seconds: float = 10, format: str = "speedscope", interval_ms: float = PROFILE_INTERVAL_MS):
+    """Sample every thread in this worker for a while and return the profile"""
+    if format not in ("speedscope", "collapsed"):
+        raise HTTPException(status_code=400, detail="format must be 'speedscope' or 'collapsed'")
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    if not profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running in this worker")
+    try:
+        sampler = StackSampler(max(1.0, interval_ms)).start()
+        await asyncio.sleep(seconds)
+        counts = await asyncio.to_thread(sampler.stop)
+    finally:
+        profile_lock.release()
+    return render_profile(counts, f"worker {os.getpid()}, {seconds:g}s", format, sampler.interval * 1000)
+
+@app.get("/api/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def admin_request_profile(profile_id: str, format: str = "speedscope"):
+    """Download the profile of a request made with X-Profile: 1"""
+    if profile_id not in request_profiles:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return render_profile(request_profiles[profile_id], f"request {profile_id}", format)
+
+def render_profile(counts: Counter, name: str, format: str, interval_ms: float = PROFILE_INTERVAL_MS):
+    if format == "collapsed":
+        return PlainTextResponse(profile_to_collapsed(counts))
+    return profile_to_speedscope(counts, name, interval_ms)
+
+@app.get("/api/gpt/speculation_stats")
+async def gpt_speculation_stats():
+    """Hit rate and spend of speculative prefetch in this worker"""
+    return {"success": True, "data": speculation_stats.summary()}
+
 @app.post("/api/validate_prompt")
 async def validate_prompt(prompt: str):
     issues = []
@@ -831,7 +2280,175 @@ def get_character_reference(story_id: str, character_name: str) -> Optional[str]
             return character_reference_cache[story_id][character_name]["image_url"]
     return None
 
+# Max DALL-E calls in flight for a single batch request
+PORTRAIT_CONCURRENCY = int(os.getenv("PORTRAIT_CONCURRENCY", "3"))
+
+def extract_json_content(raw: str) -> str:
+    """Strip whitespace and markdown code fences from a model's JSON reply"""
+    content = (raw or "").strip()
+    if not content:
+        raise Exception("OpenAI returned an empty response")
+    if content.startswith("```json"):
+        content = content.split("```json", 1)[1]
+    elif content.startswith("```"):
+        content = content.split("```", 1)[1]
+    if content.endswith("```"):
+        content = content.rsplit("```", 1)[0]
+    return content.strip()
+
+def build_cast_description_prompt(characters: List[Character], story_context: dict = None) -> str:
+    """Build one chat prompt asking for visual descriptions of the whole cast"""
+    story_parts = []
+    if story_context:
+        if story_context.get('title'):
+            story_parts.append(f"Story Title: '{story_context['title']}'")
+        if story_context.get('coreMessage'):
+            story_parts.append(f"Core Message: '{story_context['coreMessage']}'")
+        if story_context.get('targetAge'):
+            story_parts.append(f"Target Age: {story_context['targetAge']}")
+    cast_lines = [
+        f"- Name: {char.name}, Type: {char.type}, Personality: {char.personality}"
+        for char in characters
+    ]
+    return f"""
+    Write a short visual description (1-2 sentences) for each character in this children's story,
+    suitable for illustrating them as a standalone portrait. Describe appearance, colors and clothing only.
+    Keep the characters visually distinct from one another.
+
+    {' '.join(story_parts)}
+
+    Characters:
+    {chr(10).join(cast_lines)}
+
+    Return a clean JSON object mapping each character name to its visual description.
+
+    JSON output format:
+    {{
+        "Character Name": "Visual description"
+    }}
+    """
+
+async def generate_cast_descriptions(characters: List[Character], story_context: dict = None) -> Dict[str, str]:
+    """Fill in missing visual descriptions for a cast with a single chat call"""
+    missing = [char for char in characters if not char.visual_description]
+    if not missing:
+        return {}
+    response = await asyncio.to_thread(
+        create_chat_completion,
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": "You are a creative assistant for writing children's books."},
+            {"role": "user", "content": build_cast_description_prompt(missing, story_context)}
+        ],
+        temperature=0.7,
+    )
+    descriptions = json.loads(extract_json_content(response.choices[0].message.content))
+    if not isinstance(descriptions, dict):
+        raise Exception("OpenAI returned an unexpected cast description format")
+    return {str(name): str(desc) for name, desc in descriptions.items()}
+
+async def generate_character_portrait(character: Character, story_context: dict, semaphore: asyncio.Semaphore) -> dict:
+    """Generate one character portrait, waiting for a free slot in the batch"""
+    async with semaphore:
+        # The route's quota check ran once for the whole cast; each portrait spends more
+        reason = usage_tracker.over_quota(current_usage_keys.get())
+        if reason:
+            return {"name": character.name, "error": reason}
+        prompt = build_ultimate_character_prompt(character.visual_description or character.type, story_context)
+        try:
+            image_url = await generate_portrait_url(prompt)
+        except Exception as e:
+            print(f"Error generating portrait for {character.name}: {e}")
+            return {"name": character.name, "error": str(e)}
+        return {"name": character.name, "url": image_url}
+
+@app.post("/api/gpt/generate_character_portraits", dependencies=AI_ROUTE_DEPENDENCIES)
+async def gpt_generate_character_portraits(req: CharacterPortraitBatchRequest):
+    """Generate portraits for a whole cast, streaming NDJSON results as each one completes"""
+    if not OPENAI_API_KEY:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+
+    characters = req.characters
+    if not characters and req.story_id:
+        if req.story_id not in stories:
+            raise HTTPException(status_code=404, detail="Story not found")
+        characters = [char.model_copy() for char in stories[req.story_id].characters]
+    if not characters:
+        raise HTTPException(status_code=400, detail="No characters to illustrate")
+    if len(characters) > PORTRAIT_BATCH_MAX_CHARACTERS:
+        raise HTTPException(status_code=400, detail=f"At most {PORTRAIT_BATCH_MAX_CHARACTERS} characters per batch")
+    story_context = req.story_context
+    if not story_context and req.story_id in stories:
+        story_context = get_story_context(req.story_id)
+
+    try:
+        descriptions = await generate_cast_descriptions(characters, story_context)
+    except Exception as e:
+        print(f"Error generating cast descriptions: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to generate character descriptions: {e}")
+    for char in characters:
+        if not char.visual_description and descriptions.get(char.name):
+            char.visual_description = descriptions[char.name]
+    # Keep generated descriptions on the stored story so page illustrations reuse them
+    if req.story_id in stories:
+        changed = False
+        for stored in stories[req.story_id].characters:
+            if not stored.visual_description and descriptions.get(stored.name):
+                stored.visual_description = descriptions[stored.name]
+                changed = True
+        if changed:
+            mark_story_changed(req.story_id)
+
+    async def portrait_stream():
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(max(1, PORTRAIT_CONCURRENCY))
+        by_name = {char.name: char for char in characters}
+        tasks = [
+            asyncio.create_task(generate_character_portrait(char, story_context, semaphore))
+            for char in characters
+        ]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                if "error" in result:
+                    yield json.dumps({
+                        "success": False,
+                        "data": {"name": result["name"]},
+                        "detail": f"Failed to generate image: {result['error']}"
+                    }) + "\n"
+                    continue
+                if req.story_id:
+                    await store_character_reference(req.story_id, result["name"], result["url"])
+                yield json.dumps({
+                    "success": True,
+                    "data": {
+                        "name": result["name"],
+                        "url": result["url"],
+                        "visual_description": by_name[result["name"]].visual_description,
+                    }
+                }) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+        elapsed = time.perf_counter() - started
+        print(f"Generated {len(characters)} portraits in {elapsed:.1f}s")
+
+    return StreamingResponse(portrait_stream(), media_type="application/x-ndjson")
+
 # Regular API Endpoints
+@app.get("/api/usage")
+async def get_usage(request: Request):
+    """Get today's AI usage and limits for the caller"""
+    keys = get_usage_keys(request)
+    data = usage_tracker.usage_for(keys[-1])
+    if len(keys) > 1:
+        # Everyone behind the same IP shares this one
+        data["ip"] = usage_tracker.usage_for(keys[0])
+    return {
+        "success": True,
+        "data": data
+    }
+
 @app.get("/api/stories")
 async def get_stories():
     """Get all stories"""
@@ -846,13 +2463,179 @@ async def create_story(story: Story):
     """Create a new story from web interface"""
     story.id = str(uuid.uuid4())
     story.created_at = datetime.now()
+    story.version = 1
     stories[story.id] = story
+    recommend_index.update(story)
     return {
         "success": True,
         "data": story,
         "message": "Story created successfully!"
     }
 
+# Bulk import/export (NDJSON, one Story per line)
+BULK_CHUNK_SIZE = 500       # stories serialized per streamed chunk
+IMPORT_BATCH_SIZE = 1000    # stories validated before each batch is committed
+IMPORT_MAX_ERRORS = 100     # per-line errors echoed back to the caller
+IMPORT_MAX_LINE_BYTES = 1024 * 1024  # longer lines are rejected without being buffered
+
+@app.get("/api/stories/export")
+async def export_stories():
+    """Stream every story as NDJSON"""
+    async def story_stream():
+        # Only the ids are snapshotted; each story is serialized as it's reached
+        story_ids = list(stories.keys())
+        for start in range(0, len(story_ids), BULK_CHUNK_SIZE):
+            lines = []
+            for story_id in story_ids[start:start + BULK_CHUNK_SIZE]:
+                story = stories.get(story_id)
+                if story is not None:
+                    lines.append(story.model_dump_json())
+            if lines:
+                yield "\n".join(lines) + "\n"
+            await asyncio.sleep(0)
+
+    return StreamingResponse(
+        story_stream(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="stories.ndjson"'}
+    )
+
+def parse_import_lines(lines: List[Optional[bytes]], first_line: int):
+    """Validate a batch of NDJSON lines (None for one that was too long) and vectorize the stories; touches no shared state"""
+    batch = {}
+    rejected = 0
+    errors = []
+    for line_number, line in enumerate(lines, first_line):
+        if line is None:
+            rejected += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line_number, "error": f"Line is longer than {IMPORT_MAX_LINE_BYTES} bytes"})
+            continue
+        if not line.strip():
+            continue
+        try:
+            story = Story.model_validate_json(line)
+        except Exception as e:
+            rejected += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line_number, "error": str(e)})
+            continue
+        if not story.id:
+            story.id = str(uuid.uuid4())
+        if not story.created_at:
+            story.created_at = datetime.now()
+        batch[story.id] = story
+    return batch, recommend_index.vectorize(list(batch.values())), rejected, errors
+
+@app.post("/api/stories/import")
+async def import_stories(request: Request):
+    """Import stories from an NDJSON request body, keeping their ids when given"""
+    imported = 0
+    rejected = 0
+    errors = []
+    line_number = 0
+    lines = []
+
+    async def commit_batch():
+        nonlocal imported, rejected, line_number
+        # Validation and vectorizing are the slow part, so they run in a worker thread
+        batch, vectors, batch_rejected, batch_errors = await asyncio.to_thread(
+            parse_import_lines, list(lines), line_number + 1
+        )
+        line_number += len(lines)
+        lines.clear()
+        for story_id, story in batch.items():
+            # Keep versions moving forward so clients holding the old one see the change
+            if story_id in stories:
+                story.version = stories[story_id].version + 1
+        stories.update(batch)
+        for story_id in batch:
+            forget_cached_story(story_id)
+        recommend_index.update_many(list(batch.values()), vectors)
+        imported += len(batch)
+        rejected += batch_rejected
+        errors.extend(batch_errors[:IMPORT_MAX_ERRORS - len(errors)])
+
+    pending = bytearray()
+    too_long = False  # the current line went over the limit; drop the rest of it
+    async for chunk in request.stream():
+        pieces = chunk.split(b"\n")
+        for i, piece in enumerate(pieces):
+            if not too_long:
+                pending += piece
+                if len(pending) > IMPORT_MAX_LINE_BYTES:
+                    too_long = True
+                    pending.clear()
+            if i == len(pieces) - 1:
+                break  # the line continues in the next chunk
+            lines.append(None if too_long else bytes(pending))
+            pending.clear()
+            too_long = False
+            if len(lines) >= IMPORT_BATCH_SIZE:
+                await commit_batch()
+    lines.append(None if too_long else bytes(pending))
+    await commit_batch()
+
+    return {
+        "success": rejected == 0,
+        "data": {"imported": imported, "rejected": rejected, "errors": errors},
+        "message": f"Imported {imported} stories" + (f", {rejected} lines rejected" if rejected else "")
+    }
+
+def recommend(queries: List[str], story_ids: List[str], k: int) -> List[dict]:
+    """Score free-text queries and stored stories against the library in one batch"""
+    import numpy as np
+    if not 1 <= k <= RECOMMEND_MAX_K:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {RECOMMEND_MAX_K}")
+    if not queries and not story_ids:
+        raise HTTPException(status_code=400, detail="Give at least one query or story_id")
+    if len(queries) + len(story_ids) > RECOMMEND_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {RECOMMEND_MAX_QUERIES} queries per request")
+    for story_id in story_ids:
+        if story_id not in stories:
+            raise HTTPException(status_code=404, detail=f"Story not found: {story_id}")
+
+    if not recommend_index.ready:
+        raise HTTPException(status_code=503, detail="Recommendation index is still building", headers={"Retry-After": "5"})
+    vectors = [recommendation_vector([(query, 1.0)]) for query in queries]
+    vectors += [recommend_index.vector_for(story_id) for story_id in story_ids]
+    matches = recommend_index.search(np.stack(vectors), k, [None] * len(queries) + story_ids)
+
+    results = []
+    for source, found in zip([{"query": q} for q in queries] + [{"story_id": s} for s in story_ids], matches):
+        source["results"] = [
+            {
+                "id": story_id,
+                "title": stories[story_id].title,
+                "coreMessage": stories[story_id].coreMessage,
+                "age": stories[story_id].age,
+                "score": round(score, 4),
+            }
+            for story_id, score in found
+        ]
+        results.append(source)
+    return results
+
+@app.post("/api/recommend")
+async def recommend_stories(req: RecommendRequest):
+    """Find stories related to themes and/or to other stories"""
+    await recommend_index.wait_built()
+    return {
+        "success": True,
+        "data": recommend(req.queries, req.story_ids, req.k)
+    }
+
+@app.get("/api/stories/{story_id}/similar")
+async def similar_stories(story_id: str, k: int = 5):
+    """Stories most similar to this one"""
+    if story_id not in stories:
+        raise HTTPException(status_code=404, detail="Story not found")
+    await recommend_index.wait_built()
+    return {
+        "success": True,
+        "data": recommend([], [story_id], k)[0]["results"]
+    }
+
 @app.get("/api/stories/{story_id}")
 async def get_story(story_id: str):
     """Get a specific story"""
@@ -871,7 +2654,10 @@ async def update_story(story_id: str, story: Story):
     
     story.id = story_id
     story.created_at = stories[story_id].created_at
+    story.version = stories[story_id].version + 1
     stories[story_id] = story
+    forget_cached_story(story_id)
+    recommend_index.update(story)
     
     return {
         "success": True,
@@ -886,6 +2672,8 @@ async def delete_story(story_id: str):
         raise HTTPException(status_code=404, detail="Story not found")
     
     deleted_story = stories.pop(story_id)
+    forget_cached_story(story_id)
+    recommend_index.remove(story_id)
     return {
         "success": True,
         "message": f"Story '{deleted_story.title}' deleted successfully!"
@@ -899,6 +2687,7 @@ async def add_character_to_story(story_id: str, character: Character):
     
     character.id = str(uuid.uuid4())
     stories[story_id].characters.append(character)
+    mark_story_changed(story_id)
     
     return {
         "success": True,
@@ -915,6 +2704,7 @@ async def add_page_to_story(story_id: str, page: Page):
     page.id = str(uuid.uuid4())
     page.page_number = len(stories[story_id].pages) + 1
     stories[story_id].pages.append(page)
+    mark_story_changed(story_id)
     
     return {
         "success": True,
@@ -936,13 +2726,137 @@ async def export_pdf(story_id: str):
         "story_id": story_id
     }
 
+# Public reader pages (/s/{story_id}): server-rendered HTML for shared links,
+# small enough for phones and readable by link-preview crawlers.
+READER_CACHE_SIZE = int(os.getenv("READER_CACHE_SIZE", "1000"))
+# Browsers keep the page but revalidate each view, which is a 304 when unchanged
+READER_CACHE_CONTROL = "public, no-cache"
+
+READER_TEMPLATE = string.Template("""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="UTF-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>$title - JonguBooks</title>
+<meta name="description" content="$description">
+<meta property="og:type" content="book">
+<meta property="og:site_name" content="JonguBooks">
+<meta property="og:title" content="$title">
+<meta property="og:description" content="$description">
+$image_meta<meta name="twitter:card" content="$twitter_card">
+<style>
+body { font-family: 'Segoe UI', sans-serif; margin: 0; background-color: #f0f0f0; }
+.book-container { max-width: 800px; margin: 2rem auto; padding: 0 1rem; }
+.page { background-color: white; padding: 2rem; margin-bottom: 1rem; box-shadow: 0 2px 8px rgba(0,0,0,0.1); display: grid; grid-template-columns: 1fr 1fr; gap: 1.5rem; align-items: center; }
+.page.text-only { grid-template-columns: 1fr; }
+h1 { text-align: center; margin-bottom: 0.5rem; color: #333; }
+.byline { text-align: center; color: #777; margin-bottom: 2rem; }
+p { font-size: 1.1rem; line-height: 1.8; color: #444; }
+img { max-width: 100%; height: auto; border-radius: 8px; }
+.page-number { text-align: center; color: #999; margin-bottom: 1rem; font-style: italic; }
+@media (max-width: 600px) { .page { grid-template-columns: 1fr; } }
+</style>
+</head>
+<body>
+<div class="book-container">
+<h1>$title</h1>
+<div class="byline">by $author</div>
+$pages</div>
+</body>
+</html>
+""")
+
+READER_PAGE_TEMPLATE = string.Template("""<div class="page$page_class"><div class="text-content"><p>$text</p></div>$image</div>
+<div class="page-number">$page_number</div>
+""")
+
+READER_IMAGE_TEMPLATE = string.Template(
+    """<div class="image-content"><img src="$url" alt="Illustration for page $page_number" width="1024" height="1024" loading="$loading" decoding="async"></div>"""
+)
+
+READER_NOT_FOUND = """<!DOCTYPE html>
+<html lang="en"><head><meta charset="UTF-8"><title>Story not found - JonguBooks</title></head>
+<body><p>This story isn't available.</p></body></html>
+"""
+
+def render_reader_page(story: Story) -> bytes:
+    """Render a stored story as a standalone HTML reader page"""
+    escape = html.escape
+    pages = []
+    loading = "eager"
+    for page in sorted(story.pages, key=lambda p: p.page_number):
+        image = ""
+        if page.illustration_url:
+            image = READER_IMAGE_TEMPLATE.substitute(
+                url=escape(page.illustration_url),
+                page_number=page.page_number,
+                loading=loading,
+            )
+            # Only the first illustration is near the top of the page
+            loading = "lazy"
+        pages.append(READER_PAGE_TEMPLATE.substitute(
+            page_class="" if image else " text-only",
+            text=escape(page.text).replace("\n", "<br>"),
+            image=image,
+            page_number=page.page_number,
+        ))
+
+    cover = next((page.illustration_url for page in story.pages if page.illustration_url), None)
+    description = story.coreMessage or (story.pages[0].text if story.pages else "A JonguBooks story")
+    if len(description) > 200:
+        description = description[:197].rstrip() + "..."
+    return READER_TEMPLATE.substitute(
+        title=escape(story.title or "Untitled Story"),
+        description=escape(description),
+        image_meta=f'<meta property="og:image" content="{escape(cover)}">\n' if cover else "",
+        twitter_card="summary_large_image" if cover else "summary",
+        author=escape(story.author or "Anonymous"),
+        pages="".join(pages),
+    ).encode("utf-8")
+
+def get_reader_page(story_id: str) -> tuple:
+    """Return (etag, body) for a story's reader page, rendering it on a cache miss"""
+    story = stories[story_id]
+    cached = reader_cache.get(story_id)
+    if cached and cached[0] == story.version:
+        reader_cache.move_to_end(story_id)
+        return cached[1], cached[2]
+    body = render_reader_page(story)
+    # The ETag is a hash of the page itself, so identical content revalidates
+    # across edits that didn't change what readers see, and across workers
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    reader_cache[story_id] = (story.version, etag, body)
+    reader_cache.move_to_end(story_id)
+    while len(reader_cache) > READER_CACHE_SIZE:
+        reader_cache.popitem(last=False)
+    return etag, body
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+@app.get("/s/{story_id}", response_class=HTMLResponse)
+async def read_story(story_id: str, request: Request):
+    """Public, server-rendered reader page for a shared story"""
+    if story_id not in stories:
+        return HTMLResponse(READER_NOT_FOUND, status_code=404)
+    etag, body = get_reader_page(story_id)
+    headers = {"ETag": etag, "Cache-Control": READER_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="text/html; charset=utf-8", headers=headers)
+
 # Health check
 @app.get("/health")
 async def health_check():
     return {
         "status": "healthy",
         "timestamp": datetime.now(),
-        "stories_count": len(stories)
+        "stories_count": len(stories),
+        "admission": {name: pool.summary() for name, pool in admission_pools.items()}
     }
 
 if __name__ == "__main__":